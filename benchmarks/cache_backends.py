@@ -0,0 +1,104 @@
+"""
+Compares MmapCache with Django's local memory cache.
+
+Measures the operations per second of get, set and incr in a single
+process, and how many misses a number of worker processes have when
+each of them looks up the same keys, filling the cache on a miss (as
+the grant and response caches of drapes do). With the local memory
+cache, every process warms its own copy.
+
+    python benchmarks/cache_backends.py [--processes 8] [--keys 1000]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+settings.configure()
+
+from django.core.cache.backends.locmem import LocMemCache
+from django_drapes import MmapCache
+
+
+def make_cache(backend, location):
+    if backend == 'locmem':
+        return LocMemCache(location, dict(OPTIONS=dict(MAX_ENTRIES=100000)))
+    return MmapCache(location, dict(OPTIONS=dict(SLOTS=16384)))
+
+
+def ops_per_second(operation, keys, repeat):
+    started = time.time()
+    for _ in range(repeat):
+        for key in keys:
+            operation(key)
+    return len(keys) * repeat / (time.time() - started)
+
+
+def single_process(backend, location, keys, repeat):
+    cache = make_cache(backend, location)
+    value = dict(ids=range(20), name='grants')
+    results = [('set', ops_per_second(lambda key: cache.set(key, value), keys, repeat)),
+               ('get', ops_per_second(cache.get, keys, repeat))]
+    for key in keys:
+        cache.set(key + ':version', 0)
+    results.append(('incr', ops_per_second(lambda key: cache.incr(key + ':version'),
+                                           keys, repeat)))
+    return results
+
+
+def warm(backend, location, keys, misses):
+    cache = make_cache(backend, location)
+    count = 0
+    for _ in range(3):
+        for key in keys:
+            if cache.get(key) is None:
+                count += 1
+                cache.set(key, [key] * 10)
+    misses.put(count)
+
+
+def multi_process(backend, location, keys, processes):
+    misses = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=warm,
+                                       args=(backend, location, keys, misses))
+               for _ in range(processes)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(misses.get() for _ in workers), time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    options = parser.parse_args()
+    keys = ['key:%d' % i for i in range(options.keys)]
+    directory = tempfile.mkdtemp()
+    try:
+        for backend in ('locmem', 'mmap'):
+            location = os.path.join(directory, 'single-' + backend)
+            for operation, rate in single_process(backend, location, keys,
+                                                  options.repeat):
+                print '%-7s %-5s %10.0f ops/s' % (backend, operation, rate)
+        for backend in ('locmem', 'mmap'):
+            location = os.path.join(directory, 'multi-' + backend)
+            misses, elapsed = multi_process(backend, location, keys,
+                                            options.processes)
+            print '%-7s %d processes: %d misses for %d keys in %.2fs' % (
+                backend, options.processes, misses, options.keys, elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
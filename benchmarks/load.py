@@ -0,0 +1,375 @@
+"""
+Load harness for drapes-heavy endpoints.
+
+Starts a WSGI server over a small sample app on SQLite that uses
+verify, ModelValidator, require, verify_post, render_with, ListResult
+and both template tags, and sends it a mix of requests from several
+client processes. The server is started once for every combination of
+the given process and thread counts; for every configuration, the
+throughput, latency percentiles and errors (including responses with
+the wrong content, which point to shared state between requests) are
+reported.
+
+    python benchmarks/load.py --processes 1,2,4 --threads 1,4,8 \\
+        --concurrency 16 --duration 5
+"""
+import os
+import sys
+import time
+import types
+import socket
+import shutil
+import httplib
+import urllib
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from collections import Counter
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DIRECTORY = tempfile.mkdtemp()
+
+#the models of the sample app belong to this app
+drapes_load = types.ModuleType('drapes_load')
+drapes_load.__path__ = [DIRECTORY]
+sys.modules['drapes_load'] = drapes_load
+
+TEMPLATES = {
+    'thing.html': """{% load drapes %}<h1>{% modelview thing title %}</h1>
+{% if_allowed user can_edit thing %}{% modelview thing link 'Edit' %}{% else %}read only{% end_if_allowed %}""",
+    'rename.html': """<form method="post">{{ form }}</form>""",
+}
+
+from django.conf import settings
+settings.configure(
+    DEBUG=False,
+    ALLOWED_HOSTS=['*'],
+    ROOT_URLCONF='drapes_load_urls',
+    MIDDLEWARE=['drapes_load_middleware.ViewerMiddleware'],
+    INSTALLED_APPS=['drapes_load'],
+    DATABASES=dict(default=dict(ENGINE='django.db.backends.sqlite3',
+                                NAME=os.path.join(DIRECTORY, 'load.sqlite3'),
+                                OPTIONS=dict(timeout=30))),
+    TEMPLATES=[dict(BACKEND='django.template.backends.django.DjangoTemplates',
+                    OPTIONS=dict(loaders=[('django.template.loaders.locmem.Loader',
+                                           TEMPLATES)],
+                                 libraries=dict(drapes='drapes_load_tags')))])
+
+import django
+from django import forms, template
+from django.conf.urls import url
+from django.db import connections, models
+from django.http import HttpResponseRedirect
+
+
+tags = types.ModuleType('drapes_load_tags')
+sys.modules['drapes_load_tags'] = tags
+django.setup()
+
+from django_drapes import (verify, verify_post, require, render_with,
+                           ModelValidator, ModelView, ModelPermission,
+                           ListResult, Cursor, modelview, model_permission)
+
+tags.register = template.Library()
+tags.register.tag('modelview', modelview)
+tags.register.tag('if_allowed', model_permission)
+
+
+class Viewer(object):
+    is_authenticated = True
+
+    def __init__(self, name):
+        self.name = name
+
+class ViewerMiddleware(object):
+    """Takes the user from the X-Viewer header."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.user = Viewer(request.META.get('HTTP_X_VIEWER', 'anonymous'))
+        return self.get_response(request)
+
+middleware = types.ModuleType('drapes_load_middleware')
+middleware.ViewerMiddleware = ViewerMiddleware
+sys.modules['drapes_load_middleware'] = middleware
+
+
+class Owner(models.Model):
+    name = models.CharField(max_length=20, unique=True)
+
+    class Meta:
+        app_label = 'drapes_load'
+
+class Thing(models.Model):
+    owner = models.ForeignKey(Owner, on_delete=models.CASCADE)
+    slug = models.SlugField(max_length=30)
+    published = models.BooleanField(default=True)
+    note = models.CharField(max_length=50, default='')
+
+    class Meta:
+        app_label = 'drapes_load'
+
+class ThingView(ModelView):
+    model = Thing
+    select_related = ('owner',)
+
+    def title(self):
+        return '%s by %s' % (self.slug, self.owner.name)
+
+    def link(self, text):
+        return '<a href="/things/%d/rename">%s</a>' % (self.pk, text)
+
+class ThingPermission(ModelPermission):
+    model = Thing
+    select_related = ('owner',)
+
+    def can_edit(self, user):
+        return self.owner.name == user.name
+
+
+class RenameForm(forms.Form):
+    note = forms.CharField(max_length=50)
+
+
+@verify(thing=ModelValidator(Thing))
+@require(thing='published')
+@render_with('thing.html')
+def thing_page(request, thing):
+    return dict(thing=thing, user=request.user)
+
+@verify(owner=ModelValidator(Owner, get_by='name'),
+        thing=ModelValidator(Thing, get_by=['slug=thing', 'owner__name=owner']))
+@render_with('json')
+def owned_thing(request, owner, thing):
+    return dict(slug=thing.slug, owner=owner.name)
+
+@verify(cursor=Cursor())
+@render_with('json')
+def list_things(request, cursor=None):
+    return ListResult(Thing.objects.values('id', 'slug'), order_by='id',
+                      cursor=cursor, limit=20, key='things')
+
+def rename(request, thing, form):
+    Thing.objects.filter(pk=thing.pk).update(note=form.cleaned_data['note'])
+    return HttpResponseRedirect('/things/%d/' % thing.pk)
+
+@verify(thing=ModelValidator(Thing))
+@require(thing='can_edit')
+@verify_post.single(RenameForm, rename)
+@render_with('rename.html')
+def rename_page(request, thing, invalid_form=None):
+    return dict(form=invalid_form or RenameForm())
+
+
+urls = types.ModuleType('drapes_load_urls')
+urls.urlpatterns = [
+    url(r'^things/(?P<thing>\d+)/$', thing_page),
+    url(r'^owners/(?P<owner>\w+)/things/(?P<thing>[\w-]+)/$', owned_thing),
+    url(r'^things/$', list_things),
+    url(r'^things/(?P<thing>\d+)/rename$', rename_page),
+]
+sys.modules['drapes_load_urls'] = urls
+
+
+OWNERS = ['teela', 'duncan', 'adam', 'orko']
+THINGS_PER_OWNER = 50
+
+def create_data():
+    with connections['default'].schema_editor() as editor:
+        editor.create_model(Owner)
+        editor.create_model(Thing)
+    for name in OWNERS:
+        owner = Owner.objects.create(name=name)
+        Thing.objects.bulk_create([Thing(owner=owner, slug='%s-thing-%d' % (name, i))
+                                   for i in range(THINGS_PER_OWNER)])
+    connections.close_all()
+
+
+def request_mix():
+    """(method, path, body, viewer, expected status, expected content)"""
+    things = list(Thing.objects.select_related('owner'))
+    connections.close_all()
+    mix = []
+    for i, thing in enumerate(things):
+        owner = thing.owner.name
+        mix.append(('GET', '/things/%d/' % thing.pk, None, owner, 200,
+                    '%s by %s' % (thing.slug, owner)))
+        mix.append(('GET', '/owners/%s/things/%s/' % (owner, thing.slug), None,
+                    'orko', 200, '"slug": "%s"' % thing.slug))
+        if i % 5 == 0:
+            mix.append(('GET', '/things/', None, 'orko', 200, '"things"'))
+        if i % 10 == 0:
+            mix.append(('POST', '/things/%d/rename' % thing.pk,
+                        urllib.urlencode(dict(note='renamed %d' % i)), owner, 302, ''))
+    return mix
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(listener, port, threads):
+    from django.core.wsgi import get_wsgi_application
+    server = WSGIServer(('127.0.0.1', port), QuietHandler, bind_and_activate=False)
+    server.socket = listener
+    server.server_name, server.server_port = '127.0.0.1', port
+    server.setup_environ()
+    server.set_app(get_wsgi_application())
+
+    def accept():
+        while True:
+            connection, address = listener.accept()
+            try:
+                server.finish_request(connection, address)
+            except Exception:
+                server.handle_error(connection, address)
+            finally:
+                server.shutdown_request(connection)
+
+    workers = [threading.Thread(target=accept) for _ in range(threads)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    while True:
+        time.sleep(3600)
+
+
+def start_servers(processes, threads):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    port = listener.getsockname()[1]
+    servers = [multiprocessing.Process(target=serve, args=(listener, port, threads))
+               for _ in range(processes)]
+    for server in servers:
+        server.daemon = True
+        server.start()
+    listener.close()
+    return port, servers
+
+
+def send(port, method, path, body, viewer):
+    connection = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+    headers = {'X-Viewer': viewer}
+    if body is not None:
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    content = response.read()
+    connection.close()
+    return response.status, content
+
+
+def client(port, mix, offset, threads, deadline, results):
+    latencies, errors = [], Counter()
+    lock = threading.Lock()
+
+    def run(position):
+        while time.time() < deadline:
+            method, path, body, viewer, status, expected = mix[position % len(mix)]
+            position += threads
+            started = time.time()
+            try:
+                got_status, content = send(port, method, path, body, viewer)
+            except Exception, e:
+                error = type(e).__name__
+            else:
+                if got_status != status:
+                    error = 'status %d' % got_status
+                elif expected not in content:
+                    error = 'wrong content'
+                else:
+                    error = None
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                if error:
+                    errors[error] += 1
+
+    workers = [threading.Thread(target=run, args=(offset + i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    results.put((latencies, dict(errors)))
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(port, mix, concurrency, duration):
+    clients = min(concurrency, multiprocessing.cpu_count())
+    results = multiprocessing.Queue()
+    deadline = time.time() + duration
+    workers = []
+    for i in range(clients):
+        threads = concurrency // clients + (1 if i < concurrency % clients else 0)
+        workers.append(multiprocessing.Process(
+                target=client,
+                args=(port, mix, i * 997, threads, deadline, results)))
+    for worker in workers:
+        worker.start()
+    latencies, errors = [], Counter()
+    for _ in workers:
+        client_latencies, client_errors = results.get()
+        latencies.extend(client_latencies)
+        errors.update(client_errors)
+    for worker in workers:
+        worker.join()
+    return sorted(latencies), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', default='1,2,4',
+                        help='comma-separated server process counts')
+    parser.add_argument('--threads', default='1,4,8',
+                        help='comma-separated thread counts per server process')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='number of concurrent client connections')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds per configuration')
+    options = parser.parse_args()
+    try:
+        create_data()
+        mix = request_mix()
+        print '%9s %7s %8s %9s %8s %8s %8s %8s  %s' % (
+            'processes', 'threads', 'requests', 'req/s', 'p50 ms', 'p90 ms',
+            'p99 ms', 'max ms', 'errors')
+        for processes in map(int, options.processes.split(',')):
+            for threads in map(int, options.threads.split(',')):
+                port, servers = start_servers(processes, threads)
+                try:
+                    send(port, 'GET', '/things/', None, 'orko')
+                    latencies, errors = measure(port, mix, options.concurrency,
+                                                options.duration)
+                finally:
+                    for server in servers:
+                        server.terminate()
+                if not latencies:
+                    print '%9d %7d no requests completed' % (processes, threads)
+                    continue
+                print '%9d %7d %8d %9.1f %8.1f %8.1f %8.1f %8.1f  %s' % (
+                    processes, threads, len(latencies),
+                    len(latencies) / options.duration,
+                    percentile(latencies, 0.5) * 1000,
+                    percentile(latencies, 0.9) * 1000,
+                    percentile(latencies, 0.99) * 1000,
+                    latencies[-1] * 1000,
+                    ', '.join('%s: %d' % item for item in sorted(errors.items()))
+                    or '-')
+    finally:
+        shutil.rmtree(DIRECTORY)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Compares the Jinja2 extension of drapes with the Django template tags.
+
+Renders a list of objects with modelview and if_allowed for every row,
+once with the Django template engine and once with Jinja2.
+
+    python benchmarks/templates.py [--rows 500] [--repeat 20]
+"""
+import os
+import sys
+import time
+import types
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+settings.configure()
+import django
+django.setup()
+
+from django import template
+from django.template import Context, Engine
+import jinja2
+from django_drapes import (ModelView, ModelPermission, DrapesExtension,
+                           modelview, model_permission)
+
+
+DJANGO_SOURCE = """{% load drapes %}{% for thing in things %}
+{% modelview thing link 'Show' %}
+{% if_allowed user can_edit thing %}{% modelview thing link 'Edit' %}{% else %}-{% end_if_allowed %}
+{% endfor %}"""
+
+JINJA_SOURCE = """{% for thing in things %}
+{% modelview thing link 'Show' %}
+{% if_allowed user can_edit thing %}{% modelview thing link 'Edit' %}{% else %}-{% end_if_allowed %}
+{% endfor %}"""
+
+
+class Thing(object):
+    def __init__(self, pk, owner):
+        self.pk, self.owner = pk, owner
+
+class ThingView(ModelView):
+    model = Thing
+    def link(self, text):
+        return '<a href="/things/%d">%s</a>' % (self.pk, text)
+
+class ThingPermission(ModelPermission):
+    model = Thing
+    def can_edit(self, user):
+        return self.owner == user
+
+
+def django_template():
+    tags = types.ModuleType('drapes_benchmark_tags')
+    tags.register = template.Library()
+    tags.register.tag('modelview', modelview)
+    tags.register.tag('if_allowed', model_permission)
+    sys.modules['drapes_benchmark_tags'] = tags
+    engine = Engine(libraries={'drapes': 'drapes_benchmark_tags'})
+    compiled = engine.from_string(DJANGO_SOURCE)
+    return lambda context: compiled.render(Context(context))
+
+
+def jinja_template():
+    environment = jinja2.Environment(extensions=[DrapesExtension], autoescape=True)
+    return environment.from_string(JINJA_SOURCE).render
+
+
+def timed(render, context, repeat):
+    started = time.time()
+    for _ in range(repeat):
+        output = render(context)
+    return (time.time() - started) / repeat, output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    options = parser.parse_args()
+    context = dict(user='Teela',
+                   things=[Thing(i, 'Teela' if i % 2 else 'Orko')
+                           for i in range(options.rows)])
+    outputs = []
+    for name, make_template in [('django', django_template),
+                                ('jinja2', jinja_template)]:
+        elapsed, output = timed(make_template(), context, options.repeat)
+        outputs.append(output.split())
+        print '%-7s %8.2f ms per page of %d rows' % (name, elapsed * 1000,
+                                                     options.rows)
+    if outputs[0] != outputs[1]:
+        print 'warning: the outputs differ'
+
+
+if __name__ == '__main__':
+    main()
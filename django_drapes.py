@@ -2,17 +2,68 @@ import inspect
 import functools
 import formencode
 from decorator import decorator
-import copy
 import json
+import re
+import uuid
+import time
+import random
+import threading
+import logging
+import Queue
+import hashlib
+import calendar
+import base64
+import os
+import sys
+import struct
+from io import BytesIO
+import cPickle as pickle
+from collections import OrderedDict, namedtuple
 
 
 from django.template import Node, TemplateSyntaxError
 from django import template
-from django.http import HttpResponse
+import django
+from django.http import (HttpResponse,
+                         StreamingHttpResponse,
+                         HttpResponseBadRequest,
+                         HttpResponseRedirect,
+                         HttpResponseNotModified)
+from django.utils.http import http_date, parse_http_date_safe
+from django.db import models, transaction, close_old_connections
+from django.db.models import Q
+from django.db.models.query import QuerySet, ModelIterable
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.utils.cache import patch_vary_headers
+from django.utils.datastructures import MultiValueDict
+from django.core.files.uploadedfile import InMemoryUploadedFile
 try:
     from django.shortcuts import render
 except ImportError:
     pass
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import fcntl
+    import mmap
+except ImportError:
+    fcntl = None
+try:
+    import jinja2
+    from jinja2 import nodes
+    from jinja2.ext import Extension
+except ImportError:
+    jinja2 = None
+    Extension = object
+
+
+logger = logging.getLogger('django_drapes')
 
 
 class PermissionException(Exception):
@@ -23,33 +74,331 @@ class MultipleValidationErrors(Exception):
     def __init__(self, errors, *args, **kwargs):
         self.errors = errors
 
+    def as_dict(self):
+        return dict(_error_item(error) for error in self.errors)
+
 class DomainError(Exception):
     pass
 
+class PayloadTooLarge(Exception):
+    pass
+
+class MalformedPayload(Exception):
+    pass
+
 NO_INSTANCE = "No instance could be found."
 MULTIPLE_INSTANCES = "Multiple entries for validator."
 
+class NegativeCache(object):
+    """
+    Remembers the lookups of a ModelValidator that did not find an
+    instance for ttl seconds, so that they can be answered without a
+    query. At most size lookups are kept, the oldest being dropped
+    first. The cache is cleared whenever an instance of the model is
+    saved. With cache_alias, the lookups are kept in that Django cache
+    instead of the process, so that they are shared by all processes
+    using it (such as an MmapCache), and clearing bumps a generation
+    counter there.
+    """
+
+    def __init__(self, size=1024, ttl=30, cache_alias=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.cache_alias = cache_alias
+        self.namespace = 'drapes:negative'
+
+    def connect(self, model):
+        self.namespace = 'drapes:negative:%s.%s' % (model.__module__,
+                                                    model.__name__)
+        post_save.connect(self.clear, sender=model)
+
+    def key(self, kwargs):
+        key = tuple(sorted(kwargs.iteritems()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _shared_key(self, key):
+        generation_key = self.namespace + ':generation'
+        generation = _versions(caches[self.cache_alias],
+                               [generation_key])[generation_key]
+        return '%s:%s:%s' % (self.namespace, generation,
+                             hashlib.md5(repr(key)).hexdigest())
+
+    def __contains__(self, key):
+        if self.cache_alias is not None:
+            return caches[self.cache_alias].get(self._shared_key(key)) is not None
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self.entries[key]
+                return False
+            return True
+
+    def add(self, key):
+        if self.cache_alias is not None:
+            caches[self.cache_alias].set(self._shared_key(key), True, self.ttl)
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = time.time() + self.ttl
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self, **kwargs):
+        if self.cache_alias is not None:
+            _bump_version(caches[self.cache_alias], self.namespace + ':generation')
+            return
+        with self.lock:
+            self.entries.clear()
+
+
+class _LRUCache(object):
+    """
+    A thread-safe mapping that keeps only the size most recently used
+    entries.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+INTEGER_RANGES = {
+    'AutoField': (-2147483648, 2147483647),
+    'BigAutoField': (-9223372036854775808, 9223372036854775807),
+    'SmallIntegerField': (-32768, 32767),
+    'IntegerField': (-2147483648, 2147483647),
+    'BigIntegerField': (-9223372036854775808, 9223372036854775807),
+    'PositiveSmallIntegerField': (0, 32767),
+    'PositiveIntegerField': (0, 2147483647),
+}
+
+def _integer_coercer(minimum, maximum):
+    def coerce(value):
+        if value is None:
+            return value
+        #int() would turn True into 1 and truncate 3.7 to 3
+        if isinstance(value, bool) or (isinstance(value, float) and
+                                       not value.is_integer()):
+            raise ValueError("%r is not an integer" % (value,))
+        try:
+            value = int(value)
+        except TypeError:
+            raise ValueError("%r is not an integer" % (value,))
+        if not minimum <= value <= maximum:
+            raise ValueError("%d is out of range" % value)
+        return value
+    return coerce
+
+def _uuid_coercer(value):
+    if value is None or isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(value)
+    except (AttributeError, TypeError):
+        raise ValueError("%r is not a UUID" % (value,))
+
+def _length_coercer(max_length):
+    def coerce(value):
+        if isinstance(value, basestring) and len(value) > max_length:
+            raise ValueError("%r is longer than %d" % (value, max_length))
+        return value
+    return coerce
+
+def _no_coercion(value):
+    return value
+
+def _coercer_for(field):
+    #keys for foreign keys are the keys of the related model
+    while getattr(field, 'concrete', False) and (field.many_to_one or
+                                                  field.one_to_one):
+        field = field.target_field
+    internal_type = field.get_internal_type()
+    if internal_type in INTEGER_RANGES:
+        return _integer_coercer(*INTEGER_RANGES[internal_type])
+    if internal_type == 'UUIDField':
+        return _uuid_coercer
+    if getattr(field, 'max_length', None):
+        return _length_coercer(field.max_length)
+    return _no_coercion
+
+_COERCERS = {}
+
+def field_coercer(model, lookup):
+    """
+    Returns a function that converts a value for the lookup (such as
+    'id' or 'slug__iexact') on model to the type of the field, and
+    raises ValueError for values that cannot match any row. Coercers
+    are built once per model and lookup.
+    """
+    key = (model, lookup)
+    try:
+        return _COERCERS[key]
+    except KeyError:
+        pass
+    coercer = _no_coercion
+    name, _, lookup_type = lookup.partition('__')
+    meta = getattr(model, '_meta', None)
+    if meta is not None and lookup_type in ('', 'exact', 'iexact'):
+        try:
+            field = meta.pk if name == 'pk' else meta.get_field(name)
+        except FieldDoesNotExist:
+            pass
+        else:
+            coercer = _coercer_for(field)
+    _COERCERS[key] = coercer
+    return coercer
+
+
+class ReadReplicas(object):
+    """
+    Routing policy for the lookups of ModelValidator. GET and HEAD
+    requests are sent to one of the replicas, and all others to the
+    primary database. Views that write call record_write, and for
+    window seconds after that, lookups in the same session that find
+    nothing on a replica are retried on the primary. The time of the
+    last write is kept under session_key in the session, which is only
+    read when a lookup on a replica finds nothing, so that other
+    requests do not depend on the session.
+    """
+
+    SAFE_METHODS = ('GET', 'HEAD')
+
+    def __init__(self, replicas, primary='default', window=10,
+                 session_key='drapes_last_write'):
+        self.replicas = tuple(replicas)
+        self.primary = primary
+        self.window = window
+        self.session_key = session_key
+
+    def record_write(self, request):
+        session = getattr(request, 'session', None)
+        if session is not None:
+            session[self.session_key] = time.time()
+
+    def wrote_recently(self, request):
+        session = getattr(request, 'session', None)
+        if session is None:
+            return False
+        last_write = session.get(self.session_key)
+        return last_write is not None and time.time() - last_write < self.window
+
+    def alias(self, request):
+        if request is None or not self.replicas:
+            return self.primary
+        if request.method not in self.SAFE_METHODS:
+            return self.primary
+        return random.choice(self.replicas)
+
+    def retry_alias(self, request):
+        if request is not None and self.wrote_recently(request):
+            return self.primary
+        return None
+
+
 class ModelValidator(formencode.FancyValidator):
 
     messages = dict(
         no_instance = NO_INSTANCE,
         multiple_instances = MULTIPLE_INSTANCES,
         )
+    cost = 10
 
-    def __init__(self, model, get_by='id', *args, **kwargs):
+    def __init__(self, model, get_by='id', negative_cache=None, lazy=False,
+                 on_missing=None, using=None, *args, **kwargs):
         super(ModelValidator, self).__init__(*args, **kwargs)
         self.model = model
         self.get_by = get_by
         self.filters = {}
+        self.lazy = lazy
+        self.on_missing = on_missing
+        self.using = using
+        if negative_cache is True:
+            negative_cache = NegativeCache()
+        self.negative_cache = negative_cache
+        if negative_cache is not None:
+            negative_cache.connect(model)
+        if isinstance(get_by, basestring):
+            self.get_by_pairs = None
+        else:
+            self.get_by_pairs = [tuple(pair.split('=')) for pair in get_by]
+
+    def _route(self, request):
+        if self.using is None or isinstance(self.using, basestring):
+            return self.using
+        return self.using.alias(request)
+
+    def _retry_alias(self, request, using):
+        if self.using is None or isinstance(self.using, basestring):
+            return None
+        retry_using = self.using.retry_alias(request)
+        return None if retry_using == using else retry_using
+
+    def _query(self, kwargs, using):
+        objects = self.model.objects
+        if using is not None:
+            objects = objects.using(using)
+        #two rows are enough to tell a unique match from a duplicate
+        return list(objects.filter(**kwargs)[:2])
+
+    def _lookup(self, kwargs, request=None):
+        using = self._route(request)
+        key = None
+        if self.negative_cache is not None:
+            key = self.negative_cache.key(kwargs)
+            if key is not None and key in self.negative_cache:
+                return []
+        rows = self._query(kwargs, using)
+        if not rows:
+            #the row may have been written too recently to be on the
+            #replica; the session is only consulted in this case
+            retry_using = self._retry_alias(request, using)
+            if retry_using is not None:
+                rows = self._query(kwargs, retry_using)
+        if not rows and key is not None:
+            self.negative_cache.add(key)
+        return rows
+
+    def _coerce(self, kwargs):
+        #values that cannot match a row are rejected without a query
+        return dict((lookup, field_coercer(self.model, lookup)(value))
+                    for lookup, value in kwargs.iteritems())
 
     def _to_python(self, value, state):
-        #TODO if it's an id field or something integery make it an
-        #integer
         if self.filters:
             kwargs = self.filters
         else:
             kwargs = {self.get_by:value}
-        rows = self.model.objects.filter(**kwargs)
+        try:
+            kwargs = self._coerce(kwargs)
+        except (TypeError, ValueError):
+            raise formencode.Invalid(self.message('no_instance', state),
+                                     value, state)
+        rows = self._lookup(kwargs)
         if len(rows) == 0:
             raise formencode.Invalid(self.message('no_instance', state),
                                      value, state)
@@ -58,25 +407,319 @@ class ModelValidator(formencode.FancyValidator):
                                      value, state)
         return rows[0]
 
+    def _get(self, kwargs, value, request=None):
+        rows = self._lookup(kwargs, request)
+        if len(rows) == 0:
+            raise formencode.Invalid(self.message('no_instance', None), value, None)
+        if len(rows) != 1:
+            raise formencode.Invalid(self.message('multiple_instances', None),
+                                     value, None)
+        return rows[0]
+
+    def convert(self, value, context):
+        #empty values and if_invalid are handled as in to_python
+        if self.strip and isinstance(value, basestring):
+            value = value.strip()
+        if self.is_empty(value):
+            if self.not_empty:
+                raise formencode.Invalid(self.message('empty', None), value, None)
+            #optional arguments that were not passed arrive as None
+            if value is None and self.if_missing is not formencode.api.NoDefault:
+                return self.if_missing
+            if self.if_empty is not formencode.api.NoDefault:
+                return self.if_empty
+            return self.empty_value(value)
+        try:
+            return self._convert(value, context)
+        except formencode.Invalid:
+            if self.if_invalid is formencode.api.NoDefault:
+                raise
+            return self.if_invalid
+
+    def _convert(self, value, context):
+        if self.get_by_pairs is None:
+            kwargs = {self.get_by:value}
+        else:
+            kwargs = dict((filter_name, context[arg_name])
+                          for filter_name, arg_name in self.get_by_pairs)
+        try:
+            kwargs = self._coerce(kwargs)
+        except (TypeError, ValueError):
+            raise formencode.Invalid(self.message('no_instance', None), value, None)
+        request = context.get('request')
+        if not self.lazy:
+            return self._get(kwargs, value, request)
+        if self.negative_cache is not None:
+            key = self.negative_cache.key(kwargs)
+            if key is not None and key in self.negative_cache:
+                raise formencode.Invalid(self.message('no_instance', None),
+                                         value, None)
+        return LazyInstance(self, kwargs, value, request)
+
+    def resolve(self, kwargs, value, request=None):
+        """
+        Looks up the instance of a LazyInstance. If there is no single
+        instance, on_missing is called with the formencode.Invalid
+        error, and its return value is used as the instance; without
+        on_missing, the error is raised.
+        """
+        try:
+            return self._get(kwargs, value, request)
+        except formencode.Invalid, error:
+            if self.on_missing is None:
+                raise
+            return self.on_missing(error)
+
     def add_context(self, context):
-        if not isinstance(self.get_by, basestring):
-            for pair in self.get_by:
-                filter_name, arg_name = pair.split('=')
+        if self.get_by_pairs is not None:
+            for filter_name, arg_name in self.get_by_pairs:
                 self.filters[filter_name] = context[arg_name]
 
 
+_UNRESOLVED = object()
+
+class LazyInstance(object):
+    """
+    Stands in for the instance looked up by a ModelValidator with
+    lazy=True, and runs the query on first access to an attribute.
+    Its __class__ is the model of the validator, so that model views
+    and permissions are found without a query. If the lookup fails,
+    the error (of the validator, or raised by on_missing) is raised
+    again on every later access, without another query.
+    """
+
+    def __init__(self, validator, kwargs, value, request=None):
+        object.__setattr__(self, '_drapes_lookup',
+                           (validator, kwargs, value, request))
+        object.__setattr__(self, '_drapes_instance', _UNRESOLVED)
+        object.__setattr__(self, '_drapes_error', None)
+
+    def _drapes_resolve(self):
+        instance = object.__getattribute__(self, '_drapes_instance')
+        if instance is _UNRESOLVED:
+            error = object.__getattribute__(self, '_drapes_error')
+            if error is not None:
+                raise error[0], error[1], error[2]
+            validator, kwargs, value, request = object.__getattribute__(
+                self, '_drapes_lookup')
+            try:
+                instance = validator.resolve(kwargs, value, request)
+            except Exception:
+                object.__setattr__(self, '_drapes_error', sys.exc_info())
+                raise
+            object.__setattr__(self, '_drapes_instance', instance)
+        return instance
+
+    @property
+    def __class__(self):
+        return object.__getattribute__(self, '_drapes_lookup')[0].model
+
+    def __getattr__(self, name):
+        return getattr(self._drapes_resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._drapes_resolve(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._drapes_resolve(), name)
+
+    def __eq__(self, other):
+        return self._drapes_resolve() == resolve(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._drapes_resolve())
+
+    def __nonzero__(self):
+        return bool(self._drapes_resolve())
+
+    def __str__(self):
+        return str(self._drapes_resolve())
+
+    def __unicode__(self):
+        return unicode(self._drapes_resolve())
+
+    def __repr__(self):
+        return repr(self._drapes_resolve())
+
+
+def resolve(value):
+    """Returns the instance a LazyInstance stands for, or value itself."""
+    if type(value) is LazyInstance:
+        return value._drapes_resolve()
+    return value
+
+
+class Converter(object):
+    """
+    Base class for the native validators of drapes. A converter
+    implements convert(value, context), where context is the
+    dictionary of all arguments to the view, and either returns the
+    converted value or raises formencode.Invalid. Unlike formencode
+    validators, there is no state, empty value or message handling
+    involved. The cost attribute is used to order conversions when
+    verify is used with strategy='fail_fast'. If allow_none is true,
+    verify does not convert None, which is what optional arguments
+    default to.
+    """
+
+    cost = 0
+    allow_none = True
+
+    def convert(self, value, context):
+        raise NotImplementedError()
+
+    def invalid(self, message, value):
+        return formencode.Invalid(message, value, None)
+
+
+class Int(Converter):
+
+    def __init__(self, min=None, max=None):
+        self.min = min
+        self.max = max
+
+    def convert(self, value, context):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise self.invalid("Please enter an integer value", value)
+        if self.min is not None and value < self.min:
+            raise self.invalid("Please enter a number that is %s or greater" %
+                               self.min, value)
+        if self.max is not None and value > self.max:
+            raise self.invalid("Please enter a number that is %s or smaller" %
+                               self.max, value)
+        return value
+
+
+class Slug(Converter):
+
+    SLUG_RE = re.compile(r'^[-\w]+\Z')
+
+    def __init__(self, max_length=None):
+        self.max_length = max_length
+
+    def convert(self, value, context):
+        if not isinstance(value, basestring) or not self.SLUG_RE.match(value):
+            raise self.invalid("Not a valid slug", value)
+        if self.max_length is not None and len(value) > self.max_length:
+            raise self.invalid("Slug longer than %d characters" %
+                               self.max_length, value)
+        return value
+
+
+class UUID(Converter):
+
+    def convert(self, value, context):
+        if isinstance(value, uuid.UUID):
+            return value
+        try:
+            return uuid.UUID(value)
+        except (TypeError, ValueError, AttributeError):
+            raise self.invalid("Not a valid UUID", value)
+
+
+class Bool(Converter):
+
+    TRUE_VALUES = frozenset(['1', 'true', 'yes', 'on'])
+    FALSE_VALUES = frozenset(['', '0', 'false', 'no', 'off'])
+
+    def convert(self, value, context):
+        if isinstance(value, bool):
+            return value
+        if not isinstance(value, basestring):
+            value = unicode(value)
+        lowered = value.lower()
+        if lowered in self.TRUE_VALUES:
+            return True
+        if lowered in self.FALSE_VALUES:
+            return False
+        raise self.invalid("Not a boolean value", value)
+
+
+class Choice(Converter):
+
+    def __init__(self, *choices):
+        self.choices = frozenset(choices)
+
+    def convert(self, value, context):
+        if value not in self.choices:
+            raise self.invalid(u"Value must be one of: %s" %
+                               u', '.join(sorted(map(unicode, self.choices))), value)
+        return value
+
+
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value, default=unicode))
+
+class Cursor(Converter):
+    """
+    Decodes the cursors of ListResult.
+    """
+
+    def convert(self, value, context):
+        try:
+            return json.loads(base64.urlsafe_b64decode(str(value)))
+        except (TypeError, ValueError):
+            raise self.invalid("Not a valid cursor", value)
+
+
+class FormencodeAdapter(Converter):
+    """
+    Wraps a formencode validator so that it can be used through the
+    convert interface.
+    """
+
+    cost = 1
+    allow_none = False
+
+    def __init__(self, validator):
+        self.validator = validator
+        self.add_context = getattr(validator, 'add_context', None)
+        self.if_missing = getattr(validator, 'if_missing', formencode.api.NoDefault)
+
+    def convert(self, value, context):
+        if self.add_context is not None:
+            self.add_context(context)
+        return self.validator.to_python(value)
+
+
+def _as_converter(validator):
+    if hasattr(validator, 'convert'):
+        return validator
+    return FormencodeAdapter(validator)
+
+
+def _argspec(function):
+    #functions returned by drapes decorators carry the argspec of the
+    #function they wrap, which spares inspecting them again
+    try:
+        return function.drapes_argspec
+    except AttributeError:
+        return inspect.getargspec(function)
+
+def _decorate(caller, function, argspec):
+    decorated = decorator(caller, function)
+    decorated.drapes_argspec = argspec
+    return decorated
+
 def _build_args_dict(function, *args, **kwargs):
-    argspec = inspect.getargspec(function)
+    argspec = _argspec(function)
     args_dict = dict(zip(argspec[0], args))
     args_dict.update(kwargs)
     return args_dict
 
 def _is_view_func(function):
-    argspec = inspect.getargspec(function)
+    argspec = _argspec(function)
     return argspec.args and argspec.args[0] == 'request'
 
 
 def _perm_to_bool(obj, user, permission):
+    #hasattr would swallow the error of a failed lazy lookup
+    obj = resolve(obj)
     if callable(permission):
         return bool(permission(obj))
     if hasattr(obj, permission):
@@ -84,6 +727,9 @@ def _perm_to_bool(obj, user, permission):
         if callable(attr):
             return bool(attr())
         return bool(attr)
+    acl = ACL_REGISTER.get(obj.__class__)
+    if acl is not None and acl.covers(obj.__class__, permission):
+        return acl.allows(user, obj, permission)
     if PERMISSION_REGISTER.has_key(obj.__class__):
         try:
             perm = getattr(PERMISSION_REGISTER[obj.__class__](obj),
@@ -98,8 +744,8 @@ def _perm_to_bool(obj, user, permission):
     raise ValueError("Permission %r is not applicable to object %r" %
                      (permission, obj))
 
-def _call_wrapped_func(args_dict, func):
-    argspec = inspect.getargspec(func)
+def _call_wrapped_func(args_dict, func, argspec=None):
+    argspec = argspec or _argspec(func)
     args = [args_dict[arg] for arg in argspec.args]
     kwargs = dict((key, value) for key, value in args_dict.iteritems()
                   if key not in argspec.args)
@@ -108,10 +754,309 @@ def _call_wrapped_func(args_dict, func):
 def is_json(request):
     request_dict = (request.POST if request.method == 'POST'
                     else request.GET)
-    return request_dict.has_key('json') and request_dict['json']
+    return request_dict.get('json')
+
+
+VERIFY_SOURCES = ('query', 'post', 'json', 'query+json')
+VERIFY_STRATEGIES = ('collect_all', 'fail_fast')
+
+def _error_item(error):
+    return (getattr(error, 'argument_name', None),
+            getattr(error, 'msg', None) or str(error))
+
+def validation_errors(error):
+    """
+    Returns a dictionary of argument names to error messages for a
+    formencode.Invalid or MultipleValidationErrors raised by verify.
+    """
+    if isinstance(error, MultipleValidationErrors):
+        return error.as_dict()
+    return dict([_error_item(error)])
 
+def validation_error_response(error, status=400):
+    return HttpResponse(json.dumps(dict(errors=validation_errors(error)),
+                                   separators=(',', ':')),
+                        content_type='application/json',
+                        status=status)
 
-def require(**permissions):
+def payload_error_response(error):
+    """
+    Returns the JSON response for a PayloadTooLarge (status 413) or
+    MalformedPayload (status 400) raised by json_body; the message is
+    under the 'body' key of the errors.
+    """
+    if isinstance(error, PayloadTooLarge):
+        message, status = "Request body is too large", 413
+    else:
+        message, status = str(error) or "Request body is not valid JSON", 400
+    return HttpResponse(json.dumps(dict(errors=dict(body=message)),
+                                   separators=(',', ':')),
+                        content_type='application/json',
+                        status=status)
+
+def json_body(request, max_size=None):
+    """
+    Returns the JSON object in the body of a request, parsing it only
+    the first time it is requested, and raises PayloadTooLarge if the
+    body is larger than max_size bytes. An empty body is parsed as an
+    empty object.
+    """
+    try:
+        return request._drapes_json
+    except AttributeError:
+        pass
+    if max_size is not None:
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        if content_length > max_size:
+            raise PayloadTooLarge(content_length)
+    body = request.body
+    if max_size is not None and len(body) > max_size:
+        raise PayloadTooLarge(len(body))
+    if not body:
+        payload = {}
+    else:
+        try:
+            payload = json.loads(body)
+        except ValueError, e:
+            raise MalformedPayload(str(e))
+        if not isinstance(payload, dict):
+            raise MalformedPayload("JSON payload is not an object")
+    request._drapes_json = payload
+    return payload
+
+
+def _permission_name(permission):
+    return getattr(permission, '__name__', permission)
+
+
+ATTRIBUTE_COST, METHOD_COST, MODEL_PERMISSION_COST, DB_COST = range(4)
+
+def db_backed(func):
+    """
+    Marks a permission method (or the getter of a property) as
+    querying the database, so that require checks it after the cheaper
+    permissions.
+    """
+    func.drapes_cost = DB_COST
+    return func
+
+_PERMISSION_COSTS = _LRUCache(1024)
+
+def _permission_cost(obj, permission):
+    if callable(permission):
+        return getattr(permission, 'drapes_cost', METHOD_COST)
+    key = (obj.__class__, permission)
+    cost = _PERMISSION_COSTS.get(key)
+    if cost is not None:
+        return cost
+    declared = getattr(obj.__class__, permission, None)
+    if isinstance(declared, property):
+        cost = getattr(declared.fget, 'drapes_cost', ATTRIBUTE_COST)
+    elif callable(declared):
+        cost = getattr(declared, 'drapes_cost', METHOD_COST)
+    elif declared is not None or hasattr(resolve(obj), permission):
+        cost = ATTRIBUTE_COST
+    elif permission in getattr(ACL_REGISTER.get(obj.__class__), 'permissions',
+                               {}).get(obj.__class__, ()):
+        cost = DB_COST
+    else:
+        method = getattr(PERMISSION_REGISTER.get(obj.__class__), permission, None)
+        cost = getattr(method, 'drapes_cost', MODEL_PERMISSION_COST)
+    _PERMISSION_COSTS.set(key, cost)
+    return cost
+
+
+class PermissionExpression(object):
+    """
+    Base of the nodes of permission expressions, which are combined
+    with &, | and ~. Evaluation orders the operands of & and | by
+    their cost and stops as soon as the outcome is decided.
+    """
+
+    def __and__(self, other):
+        return AllOf(self, _expression(other))
+
+    def __or__(self, other):
+        return AnyOf(self, _expression(other))
+
+    def __invert__(self):
+        return NotAllowed(self)
+
+    def __rand__(self, other):
+        return AllOf(_expression(other), self)
+
+    def __ror__(self, other):
+        return AnyOf(_expression(other), self)
+
+    def _operand(self):
+        return str(self)
+
+
+class Perm(PermissionExpression):
+    """
+    A named permission (or a callable, as in require) of the object
+    on, which is the name of an argument of the view or 'user'. When
+    used as the value of a keyword argument of require, on defaults to
+    the keyword.
+    """
+
+    def __init__(self, permission, on=None):
+        self.permission = permission
+        self.on = on
+
+    def bind(self, key):
+        if self.on is not None:
+            return self
+        if key is None:
+            raise ValueError("Permission %r does not name an object" %
+                             (self.permission,))
+        return Perm(self.permission, key)
+
+    def names(self):
+        return set([self.on])
+
+    def cost(self, args_dict):
+        return _permission_cost(args_dict[self.on], self.permission)
+
+    def evaluate(self, args_dict):
+        return _perm_to_bool(args_dict[self.on], args_dict['user'],
+                             self.permission)
+
+    def __str__(self):
+        name = _permission_name(self.permission)
+        return name if self.on is None else '%s.%s' % (self.on, name)
+
+
+class _Operation(PermissionExpression):
+
+    def __init__(self, *operands):
+        self.operands = operands
+
+    def bind(self, key):
+        return self.__class__(*[operand.bind(key) for operand in self.operands])
+
+    def names(self):
+        return set().union(*[operand.names() for operand in self.operands])
+
+    def cost(self, args_dict):
+        return sum(operand.cost(args_dict) for operand in self.operands)
+
+    def _ordered(self, args_dict):
+        return sorted(self.operands, key=lambda operand: operand.cost(args_dict))
+
+    def _operand(self):
+        return '(%s)' % self
+
+    def __str__(self):
+        return self.symbol.join(operand._operand() for operand in self.operands)
+
+
+class AllOf(_Operation):
+    symbol = ' & '
+
+    def evaluate(self, args_dict):
+        return all(operand.evaluate(args_dict)
+                   for operand in self._ordered(args_dict))
+
+
+class AnyOf(_Operation):
+    symbol = ' | '
+
+    def evaluate(self, args_dict):
+        return any(operand.evaluate(args_dict)
+                   for operand in self._ordered(args_dict))
+
+
+class NotAllowed(_Operation):
+
+    def cost(self, args_dict):
+        return self.operands[0].cost(args_dict)
+
+    def evaluate(self, args_dict):
+        return not self.operands[0].evaluate(args_dict)
+
+    def _operand(self):
+        return str(self)
+
+    def __str__(self):
+        return '~' + self.operands[0]._operand()
+
+
+PERMISSION_TOKEN_RE = re.compile(r'\s*(?:([()&|~])|([A-Za-z_][\w.]*))')
+
+def _tokenize_permission(text):
+    tokens, position = [], 0
+    text = text.strip()
+    while position < len(text):
+        match = PERMISSION_TOKEN_RE.match(text, position)
+        if match is None:
+            raise ValueError("Invalid permission expression %r" % text)
+        tokens.append(match.group(1) or match.group(2))
+        position = match.end()
+    return tokens
+
+def parse_permission(text):
+    """
+    Parses a permission expression such as 'published & ~archived' or
+    'thing.owned_by | user.is_staff'. Names with a dot name the object
+    the permission is checked on.
+    """
+    tokens = _tokenize_permission(text)
+
+    def expect(token):
+        if not tokens or tokens.pop(0) != token:
+            raise ValueError("Invalid permission expression %r" % text)
+
+    def any_of():
+        operands = [all_of()]
+        while tokens and tokens[0] == '|':
+            tokens.pop(0)
+            operands.append(all_of())
+        return operands[0] if len(operands) == 1 else AnyOf(*operands)
+
+    def all_of():
+        operands = [negation()]
+        while tokens and tokens[0] == '&':
+            tokens.pop(0)
+            operands.append(negation())
+        return operands[0] if len(operands) == 1 else AllOf(*operands)
+
+    def negation():
+        if tokens and tokens[0] == '~':
+            tokens.pop(0)
+            return NotAllowed(negation())
+        return atom()
+
+    def atom():
+        if not tokens:
+            raise ValueError("Invalid permission expression %r" % text)
+        token = tokens.pop(0)
+        if token == '(':
+            expression = any_of()
+            expect(')')
+            return expression
+        if token in ')&|~':
+            raise ValueError("Invalid permission expression %r" % text)
+        on, _, name = token.rpartition('.')
+        return Perm(name, on or None)
+
+    expression = any_of()
+    if tokens:
+        raise ValueError("Invalid permission expression %r" % text)
+    return expression
+
+def _expression(permission):
+    if isinstance(permission, PermissionExpression):
+        return permission
+    if isinstance(permission, basestring):
+        return parse_permission(permission)
+    return Perm(permission)
+
+
+def require(*expressions, **permissions):
     """
     A decorator for checking permissions on in incoming
     request. Accepts keyword arguments referring either to user
@@ -124,18 +1069,47 @@ def require(**permissions):
     - A method of the object
     - A method of the model permission (a subclass of ModelPermission;
       see below) that accepts a user as argument.
+    The string can also be an expression combining permissions with
+    &, | and ~, and positional arguments are expressions whose
+    permissions name their objects, as in 'user.is_staff'. The checks
+    are ordered from attributes to methods of the object, methods of
+    the model permission and methods marked with db_backed, and stop
+    as soon as a check fails.
     """
-    @decorator
-    def deco(view_func, *args, **kwargs):
-        args_dict = _build_args_dict(view_func, *args, **kwargs)
-        args_dict['user'] = args[0].user
-        for key, permission in permissions.iteritems():
-            if not _perm_to_bool(args_dict[key], args[0].user, permission):
-                raise PermissionException('%s is not allowed to %s' %
-                                          (key, permission))
-        return view_func(*args, **kwargs)
-
-    return deco
+    checks = [(key, _expression(permission))
+              for key, permission in sorted(permissions.iteritems())]
+    checks.extend((None, _expression(expression)) for expression in expressions)
+    granted = tuple(sorted((key or '', str(expression))
+                           for key, expression in checks))
+    checks = [(key, expression, expression.bind(key))
+              for key, expression in checks]
+
+    def wrap(view_func):
+        argspec = _argspec(view_func)
+
+        def deco(view_func, *args, **kwargs):
+            request = args[0]
+            args_dict = dict(zip(argspec.args, args))
+            args_dict.update(kwargs)
+            args_dict['user'] = request.user
+            #lazy objects are looked up before their permissions are
+            #probed, so that a failed lookup is raised and not swallowed
+            for name in set().union(*[check[2].names() for check in checks]):
+                args_dict[name] = resolve(args_dict[name])
+            for key, expression, bound in sorted(
+                    checks, key=lambda check: check[2].cost(args_dict)):
+                if not bound.evaluate(args_dict):
+                    if key is None:
+                        raise PermissionException('Not allowed: %s' % expression)
+                    raise PermissionException('%s is not allowed to %s' %
+                                              (key, expression))
+            #the outcomes are recorded for the response cache of render_with
+            request._drapes_permissions = (getattr(request, '_drapes_permissions', ())
+                                           + granted)
+            return view_func(*args, **kwargs)
+        return _decorate(deco, view_func, argspec)
+
+    return wrap
 
 def verify(**conversions):
     """
@@ -154,145 +1128,1462 @@ def verify(**conversions):
     parameter into an argument. If you want the GET dictionary to be
     included in verification, the first argument of the controller has
     to be called 'request'.
-    """
-
-    def _validate(argname, all_args):
-        if conversions.has_key(argname):
-            validator = conversions[argname]
-            if hasattr(validator, 'add_context'):
-                validator.add_context(all_args)
-            return validator.to_python(all_args[argname])
-        return all_args[argname]
 
-    @decorator
-    def deco(view_func, *deco_args, **deco_kwargs):
-        args_dict = _build_args_dict(view_func, *deco_args, **deco_kwargs)
-
-        if _is_view_func(view_func):
-            request = deco_args[0]
-            if request.method == "GET":
-                #we have to do this because get params are passed on as a list
-                flattened = ((key,val) for key,val in request.GET.iteritems()
-                             if key != 'json')
-                args_dict.update(dict(flattened))
+    Only the GET parameters that are either converted or accepted as
+    arguments by the controller are taken into account; which ones
+    these are is determined once, when the decorator is applied. Pass
+    passthrough=True in order to forward all GET parameters to the
+    controller instead (this makes passthrough a reserved name).
+
+    Where the parameters are taken from is set with the source keyword
+    argument, which can be one of 'query' (the default; the GET
+    parameters of a GET request), 'post' (the POST parameters of a POST
+    request), 'json' (the JSON object in the request body) or
+    'query+json' (both GET parameters and the JSON body, the latter
+    taking precedence). The JSON body is parsed only once per request
+    (see json_body), and bodies larger than max_body_size bytes are
+    rejected with PayloadTooLarge before parsing.
+
+    With strategy='collect_all' (the default), all conversions are
+    run, and the errors are raised together as MultipleValidationErrors
+    if there are more than one. With strategy='fail_fast', conversions
+    are run in the order of their cost (converters first, then
+    formencode validators, then database lookups), and the first error
+    is raised right away. If json_errors is true, the errors are
+    returned as a JSON response with status 400 instead of being raised
+    (see validation_error_response); so are bodies that are too large
+    (with status 413) or not a JSON object (see payload_error_response).
+
+    Validators can either be formencode validators, or implement the
+    convert(value, context) interface of drapes converters (see
+    Converter). The latter are called directly, which is considerably
+    cheaper.
+    """
 
-        validated_args_dict = dict()
+    passthrough = conversions.pop('passthrough', False)
+    source = conversions.pop('source', 'query')
+    max_body_size = conversions.pop('max_body_size', None)
+    strategy = conversions.pop('strategy', 'collect_all')
+    json_errors = conversions.pop('json_errors', False)
+    if source not in VERIFY_SOURCES:
+        raise ValueError("Unknown source %r for verify" % source)
+    if strategy not in VERIFY_STRATEGIES:
+        raise ValueError("Unknown strategy %r for verify" % strategy)
+    converters = dict((argname, _as_converter(validator))
+                      for argname, validator in conversions.iteritems())
+    fail_fast = strategy == 'fail_fast'
+    #cheap conversions first, so that failing ones spare the db lookups
+    conversion_order = sorted(converters,
+                              key=lambda argname: getattr(converters[argname],
+                                                          'cost',
+                                                          FormencodeAdapter.cost))
+
+    def _validate(args_dict):
+        validated_args_dict = dict(args_dict)
         errors = []
-        for argument_name in args_dict:
+        for argument_name in conversion_order:
+            converter = converters[argument_name]
+            if argument_name not in args_dict:
+                #formencode validators can give a value for missing arguments
+                if_missing = getattr(converter, 'if_missing', formencode.api.NoDefault)
+                if if_missing is not formencode.api.NoDefault:
+                    validated_args_dict[argument_name] = if_missing
+                continue
+            value = args_dict[argument_name]
+            if value is None and getattr(converter, 'allow_none', False):
+                continue
             try:
-                validated_args_dict[argument_name] = _validate(argument_name,
-                                                               args_dict)
+                validated_args_dict[argument_name] = converter.convert(value,
+                                                                       args_dict)
             except formencode.Invalid, f:
+                f.argument_name = argument_name
+                if fail_fast:
+                    raise
                 errors.append(f)
         if len(errors) == 1:
             raise errors[0]
         elif errors:
             raise MultipleValidationErrors(errors)
+        return validated_args_dict
+
+    def _get_params(params, get_names):
+        if passthrough:
+            #we have to do this because get params are passed on as a list
+            return dict((key,val) for key,val in params.iteritems()
+                        if key != 'json')
+        return dict((name, params[name]) for name in get_names if name in params)
+
+    def _request_params(request, get_names):
+        if source == 'query':
+            if request.method == "GET":
+                return _get_params(request.GET, get_names)
+            return {}
+        if source == 'post':
+            if request.method == "POST":
+                return _get_params(request.POST, get_names)
+            return {}
+        payload = _get_params(json_body(request, max_body_size), get_names)
+        if source == 'json':
+            return payload
+        params = _get_params(request.GET, get_names)
+        params.update(payload)
+        return params
+
+    def wrap(view_func):
+        argspec = _argspec(view_func)
+        is_view_func = _is_view_func(view_func)
+        get_names = tuple(name for name in set(argspec.args[1:]) | set(converters)
+                          if name != 'json')
+
+        def deco(view_func, *deco_args, **deco_kwargs):
+            args_dict = dict(zip(argspec.args, deco_args))
+            args_dict.update(deco_kwargs)
+
+            if is_view_func:
+                try:
+                    args_dict.update(_request_params(deco_args[0], get_names))
+                except (PayloadTooLarge, MalformedPayload), e:
+                    if json_errors:
+                        return payload_error_response(e)
+                    raise
+
+            try:
+                validated_args_dict = _validate(args_dict)
+            except (formencode.Invalid, MultipleValidationErrors), e:
+                if json_errors:
+                    return validation_error_response(e)
+                raise
 
-        return _call_wrapped_func(validated_args_dict, view_func)
-    return deco
+            return _call_wrapped_func(validated_args_dict, view_func, argspec)
+        return _decorate(deco, view_func, argspec)
+    return wrap
 
 class NonmatchingHandlerArgspecs(Exception):
     pass
 
+class InlineExecutor(object):
+    """
+    Runs submitted calls right away; this is what verify_post does
+    when no executor is given.
+    """
+
+    def submit(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+class ThreadExecutor(object):
+    """
+    Runs submitted calls in a pool of daemon threads, which are
+    started with the first call. Exceptions are logged. As in a
+    request, database connections that are broken or past their
+    CONN_MAX_AGE are closed before and after every call.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            close_old_connections()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception("Error in background call to %r", func)
+            finally:
+                close_old_connections()
+                self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        if not self.threads:
+            with self.lock:
+                while len(self.threads) < self.workers:
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put((func, args, kwargs))
+
+    def join(self):
+        self.queue.join()
+
+
+class OnCommitExecutor(object):
+    """
+    Runs submitted calls once the current transaction on the database
+    using is committed (right away if there is none).
+    """
+
+    def __init__(self, using=None):
+        self.using = using
+
+    def submit(self, func, *args, **kwargs):
+        transaction.on_commit(lambda: func(*args, **kwargs), using=self.using)
+
+
+class QueueExecutor(object):
+    """
+    Collects submitted calls until run is called. Useful in tests, and
+    for handing the calls over to a worker of your own.
+    """
+
+    def __init__(self):
+        self.pending = []
+
+    def submit(self, func, *args, **kwargs):
+        self.pending.append((func, args, kwargs))
+
+    def run(self):
+        while self.pending:
+            func, args, kwargs = self.pending.pop(0)
+            func(*args, **kwargs)
+
+
+def after_commit(background):
+    """
+    Declares background as the part of a valid form handler that can
+    be run by the executor of verify_post, after the handler returned
+    its response. background is called with the same arguments as the
+    handler.
+    """
+    def wrap(valid_handler):
+        valid_handler.after_commit = background
+        return valid_handler
+    return wrap
+
+
+def _detached_files(files):
+    """
+    Copies the uploads of a request into memory. The request closes
+    them when it ends, and removes the temporary files of large ones,
+    so they cannot be read by work running after it.
+    """
+    detached = MultiValueDict()
+    for key, uploads in files.lists():
+        copies = []
+        for upload in uploads:
+            content = ''.join(upload.chunks())
+            copies.append(InMemoryUploadedFile(
+                BytesIO(content), upload.field_name, upload.name,
+                upload.content_type, len(content), upload.charset,
+                upload.content_type_extra))
+        detached.setlist(key, copies)
+    return detached
+
+
+FormHandler = namedtuple('FormHandler', 'form_class valid_handler pass_user')
+
+def _form_handler(form_class, valid_handler, pass_user=False):
+    return FormHandler(form_class, valid_handler, bool(pass_user))
+
+
 class verify_post(object):
     """
     A decorator for splitting responsibilities and improving
     validations on a page that handles both get and post requests.
+
+    Work done by the valid handlers can be moved out of the request
+    with an executor (see InlineExecutor, ThreadExecutor,
+    OnCommitExecutor and QueueExecutor). If a valid handler declares
+    an after_commit part, the handler is called as usual, and that
+    part is submitted to the executor. Otherwise the whole handler is
+    submitted, and response (a url to redirect to, or a callable
+    accepting the request) is returned. With an executor other than
+    InlineExecutor, the uploaded files are copied into memory before
+    the form is bound, so that the work submitted can still read them
+    after the request.
     """
 
+    executor = None
+    response = None
+
+    def _set_executor(self, executor, response):
+        self.executor = executor
+        if isinstance(response, basestring):
+            url = response
+            response = lambda request: HttpResponseRedirect(url)
+        self.response = response
+
     @classmethod
-    def single(cls, form_class, valid_handler, pass_user=False):
+    def single(cls, form_class, valid_handler, pass_user=False,
+               executor=None, response=None):
         verifier = cls()
+        verifier._set_executor(executor, response)
         verifier.multi = False
         verifier.form_class = form_class
         verifier.valid_handler = valid_handler
         verifier.pass_user = pass_user
+        verifier.handler = _form_handler(form_class, valid_handler, pass_user)
         return verifier
 
     @classmethod
     def multi(cls, **forms):
+        """
+        The form options are normalized into FormHandler tuples, and
+        looked up by the value of the FORM_FIELD_NAME POST parameter. A
+        POST with a missing or unknown form name is answered with 400
+        Bad Request. executor and response are reserved, and cannot
+        be used as form names.
+        """
         verifier = cls()
+        verifier._set_executor(forms.pop('executor', None),
+                               forms.pop('response', None))
         verifier.multi = True
-        verifier.forms = forms
+        verifier.forms = dict((form_name, _form_handler(*form_info))
+                              for form_name, form_info in forms.iteritems())
         return verifier
 
 
-    def _match_handlers(self, default_handler):
-        def _compare_funcs(base_func, valid_handler, remove_args=None):
-            remove_args = remove_args or ['invalid_form']
-            default_args = copy.copy(inspect.getargspec(default_handler).args)
-            for x in remove_args:
-                default_args.remove(x)
-            valid_args = copy.copy(inspect.getargspec(valid_handler).args)
-            valid_args.remove('form')
-            if not default_args == valid_args:
-                raise NonmatchingHandlerArgspecs()
+    def _form_keys(self):
+        return self.forms.keys() if self.multi else ['invalid_form']
 
-        if self.multi:
-            remove_args = self.forms.keys()
-            for form_info in self.forms.values():
-                _compare_funcs(default_handler, form_info[1], remove_args)
-        else:
-            _compare_funcs(default_handler, self.valid_handler)
+    def _handlers(self):
+        return self.forms.values() if self.multi else [self.handler]
+
+    def _match_handlers(self, default_args):
+        form_keys = self._form_keys()
+        if not all(key in default_args for key in form_keys):
+            raise NonmatchingHandlerArgspecs()
+        default_args = [arg for arg in default_args if arg not in form_keys]
+        for handler in self._handlers():
+            valid_args = _argspec(handler.valid_handler).args
+            if not 'form' in valid_args:
+                raise NonmatchingHandlerArgspecs()
+            if not [arg for arg in valid_args if arg != 'form'] == default_args:
+                raise NonmatchingHandlerArgspecs()
+            background = getattr(handler.valid_handler, 'after_commit', None)
+            if background is not None:
+                if not _argspec(background).args == valid_args:
+                    raise NonmatchingHandlerArgspecs()
+            elif self.executor is not None and self.response is None:
+                raise ValueError("A response is needed for running %r "
+                                 "with an executor" % handler.valid_handler)
 
     FORM_FIELD_NAME = 'drape_form_name'
 
     def __call__(self, view_func):
-        self._match_handlers(view_func)
-
-        def replacement_func(request, *args, **kwargs):
+        """
+        The handlers are matched against the controller, and the
+        positions of the form arguments computed, when the decorator is
+        applied. At request time, forms are inserted into the positional
+        arguments the controller is called with, without inspecting or
+        copying keyword arguments.
+        """
+        argspec = _argspec(view_func)
+        default_args = argspec.args
+        self._match_handlers(default_args)
+        form_positions = dict((key, default_args.index(key))
+                              for key in self._form_keys())
+        #for every valid handler, where its arguments are found in the
+        #arguments to the controller; None marks the form
+        valid_positions = dict(
+            (handler.valid_handler,
+             tuple(None if arg == 'form' else default_args.index(arg)
+                   for arg in _argspec(handler.valid_handler).args))
+            for handler in self._handlers())
+        arg_count = len(default_args)
+
+        def replacement_func(view_func, *args, **kwargs):
+            request = args[0]
             if not request.method == 'POST':
-                return view_func(request, *args, **kwargs)
+                return view_func(*args, **kwargs)
 
             if self.multi:
-                form_name = request.POST[self.FORM_FIELD_NAME]
-                if not form_name in self.forms:
-                    raise ValueError('No POST handler set for form %s' % form_name)
-                form_info = self.forms[form_name]
-                form_class = form_info[0]
-                valid_handler = form_info[1]
-                pass_user = form_info[2]  if len(form_info) == 3 else False
+                form_name = request.POST.get(self.FORM_FIELD_NAME)
+                handler = self.forms.get(form_name)
+                if handler is None:
+                    return HttpResponseBadRequest('No POST handler set for form %s' %
+                                                  form_name)
             else:
-                form_class, valid_handler, pass_user = (self.form_class,
-                                                        self.valid_handler,
-                                                        self.pass_user)
+                form_name = 'invalid_form'
+                handler = self.handler
+            form_class, valid_handler, pass_user = handler
+            files = request.FILES
+            if files and self.executor is not None and \
+                    not isinstance(self.executor, InlineExecutor):
+                files = _detached_files(files)
             if pass_user:
-                form = form_class(request.POST, user=request.user)
+                form = form_class(request.POST, files, user=request.user)
             else:
-                form = form_class(request.POST)
+                form = form_class(request.POST, files)
             if not form.is_valid():
-                key = form_name if self.multi else 'invalid_form'
-                kwargs[key] = form
-                return view_func(request, *args, **kwargs)
+                position = form_positions[form_name]
+                return view_func(*(args[:position] + (form,) + args[position+1:]),
+                                 **kwargs)
             else:
-                kwargs['form'] = form
-                return valid_handler(request,
-                                     *args,
-                                     **kwargs)
-        return replacement_func
+                valid_args = tuple(form if position is None else args[position]
+                                   for position in valid_positions[valid_handler])
+                valid_args += args[arg_count:]
+                if self.executor is None:
+                    return valid_handler(*valid_args, **kwargs)
+                background = getattr(valid_handler, 'after_commit', None)
+                if background is None:
+                    self.executor.submit(valid_handler, *valid_args, **kwargs)
+                    return self.response(request)
+                response = valid_handler(*valid_args, **kwargs)
+                self.executor.submit(background, *valid_args, **kwargs)
+                return response
+        return _decorate(replacement_func, view_func, argspec)
+
+
+def _identity(obj):
+    return '%s.%s' % (obj.__class__.__name__, getattr(obj, 'pk', obj))
+
+def version_of(*arg_names, **kwargs):
+    """
+    An etag strategy for render_with that combines the identities and
+    the version field (by default 'version') of arguments to the
+    controller.
+    """
+    field = kwargs.get('field', 'version')
+    def etag(args_dict):
+        return ';'.join('%s:%s' % (_identity(args_dict[name]),
+                                   getattr(args_dict[name], field))
+                        for name in arg_names)
+    return etag
+
+def latest_of(*arg_names, **kwargs):
+    """
+    A last_modified strategy for render_with that returns the latest
+    of the timestamp field (by default 'modified') of arguments to the
+    controller.
+    """
+    field = kwargs.get('field', 'modified')
+    def last_modified(args_dict):
+        return max(getattr(args_dict[name], field) for name in arg_names)
+    return last_modified
+
+def _quoted_etag(value):
+    return '"%s"' % hashlib.md5(value).hexdigest()
+
+def _etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+def _not_modified_since(request, timestamp):
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    return since is not None and timestamp <= since
+
+def _is_not_modified(request, etag, timestamp):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    if etag is not None and request.META.get('HTTP_IF_NONE_MATCH'):
+        return _etag_matches(request, etag)
+    return timestamp is not None and _not_modified_since(request, timestamp)
+
+def _set_validators(response, etag, timestamp):
+    if etag is not None:
+        response['ETag'] = etag
+    if timestamp is not None:
+        response['Last-Modified'] = http_date(timestamp)
+    return response
+
+
+def _is_anonymous(user):
+    authenticated = getattr(user, 'is_authenticated', False)
+    if callable(authenticated):
+        authenticated = authenticated()
+    return not authenticated
+
+
+def _fresh_version():
+    #counters are ordinary cache entries, which can be evicted; one that
+    #is missing starts again at a random value rather than at a fixed
+    #one, so that entries stored under its earlier values stay stale
+    return random.getrandbits(62)
+
+def _versions(cache, keys):
+    """The values of the version counters keys, seeding missing ones."""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if versions.get(key) is None:
+            cache.add(key, _fresh_version(), None)
+            versions[key] = cache.get(key)
+            if versions[key] is None:
+                versions[key] = _fresh_version()
+    return versions
+
+def _bump_version(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, _fresh_version(), None)
+
+
+class ResponseCache(object):
+    """
+    Settings for caching complete responses with render_with. The
+    cache key is built from the controller, the full path of the
+    request, the template name, the arguments to the
+    controller (instances of models by their class, primary key and
+    version_field if given), the permissions checked by require, and
+    the outcome of the permissions given here, which are checked for
+    every request; the user id is not part of it. Responses are cached
+    in the cache named cache_alias for timeout seconds, and saving or
+    deleting an instance of one of models invalidates all responses
+    cached with this object. With anonymous_only, only requests of
+    anonymous users are served from the cache. Responses that use the
+    CSRF token, the session or cookies are not stored.
+    """
+
+    def __init__(self, timeout=300, cache_alias='default', models=(),
+                 permissions=None, version_field=None, anonymous_only=True):
+        self.timeout = timeout
+        self.cache_alias = cache_alias
+        self.models = tuple(models)
+        self.permissions = sorted((permissions or {}).iteritems())
+        self.version_field = version_field
+        self.anonymous_only = anonymous_only
+        self.generation_keys = [self._generation_key(model) for model in self.models]
+        for model in self.models:
+            post_save.connect(self.invalidate, sender=model)
+            post_delete.connect(self.invalidate, sender=model)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _generation_key(self, model):
+        return 'drapes:generation:%s.%s' % (model.__module__, model.__name__)
+
+    def invalidate(self, sender, **kwargs):
+        _bump_version(self.cache, self._generation_key(sender))
+
+    def _identity(self, value):
+        if hasattr(value, '_meta') and hasattr(value, 'pk'):
+            version = (getattr(value, self.version_field, None)
+                       if self.version_field else None)
+            return '%s:%s' % (_identity(value), version)
+        return repr(value)
+
+    def key(self, view_name, template_name, request, args_dict, variant):
+        generations = _versions(self.cache, self.generation_keys)
+        #views sharing a template, or reading request.GET themselves,
+        #must not share responses
+        parts = [view_name,
+                 request.get_full_path(),
+                 template_name,
+                 str(variant),
+                 repr(getattr(request, '_drapes_permissions', ())),
+                 repr([generations.get(key) for key in self.generation_keys])]
+        for name in sorted(args_dict):
+            if name != 'request':
+                parts.append('%s=%s' % (name, self._identity(args_dict[name])))
+        for name, permission in self.permissions:
+            obj = request.user if name == 'user' else args_dict[name]
+            parts.append('%s:%s' % (name, _perm_to_bool(obj,
+                                                        request.user,
+                                                        permission)))
+        return 'drapes:response:' + hashlib.md5('|'.join(parts)).hexdigest()
+
+    def applies_to(self, request):
+        return (request.method in ('GET', 'HEAD') and
+                (not self.anonymous_only or _is_anonymous(request.user)))
+
+    def storable(self, request, response):
+        """
+        Whether response can be served to other requests: not if it
+        depends on the CSRF token, the session or the cookies of this
+        request, or sets cookies of its own.
+        """
+        if request.META.get('CSRF_COOKIE_USED'):
+            return False
+        session = getattr(request, 'session', None)
+        if session is not None and getattr(session, 'accessed', False):
+            return False
+        vary = response.get('Vary', '') if hasattr(response, 'get') else ''
+        if 'cookie' in vary.lower():
+            return False
+        return not getattr(response, 'cookies', None)
+
+
+class GrantCache(object):
+    """
+    Per-user cache of grants, for use in ModelPermission methods. A
+    grant is a relation name registered with a loader, a function that
+    returns the ids of the objects a user is related to through it,
+    e.g. the projects the user is a member of. The sets are stored in
+    the cache named cache_alias and memoized on the user object for
+    the rest of the request. Every relation has a version counter which
+    is bumped when an instance of one of its senders is saved or
+    deleted, or its many-to-many relations change; invalidate bumps it
+    by hand, for all users or only for one.
+    """
+
+    def __init__(self, cache_alias='default', timeout=3600):
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.loaders = {}
+        self._receivers = []
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def register(self, relation, loader, senders=()):
+        self.loaders[relation] = loader
+        def receiver(sender, **kwargs):
+            self.invalidate(relation)
+        self._receivers.append(receiver)
+        for sender in senders:
+            for signal in (post_save, post_delete, m2m_changed):
+                signal.connect(receiver, sender=sender, weak=False)
+
+    def register_groups(self):
+        """Registers the names of the groups of a user as 'groups'."""
+        from django.contrib.auth import get_user_model
+        through = get_user_model().groups.through
+        self.register('groups',
+                      lambda user: user.groups.values_list('name', flat=True),
+                      senders=[through])
+
+    def _version_key(self, relation, user=None):
+        if user is None:
+            return 'drapes:grants:%s:version' % relation
+        return 'drapes:grants:%s:%s:version' % (relation, user.pk)
+
+    def invalidate(self, relation, user=None):
+        _bump_version(self.cache, self._version_key(relation, user))
+
+    def ids(self, user, relation):
+        if getattr(user, 'pk', None) is None:
+            return frozenset()
+        memo = user.__dict__.setdefault('_drapes_grants', {})
+        if relation in memo:
+            return memo[relation]
+        loader = self.loaders[relation]
+        version_keys = [self._version_key(relation),
+                        self._version_key(relation, user)]
+        versions = _versions(self.cache, version_keys)
+        key = 'drapes:grants:%s:%s:%s:%s' % ((relation, user.pk) +
+                                              tuple(versions[version_key]
+                                                    for version_key in version_keys))
+        grants = self.cache.get(key)
+        if grants is None:
+            grants = frozenset(loader(user))
+            self.cache.set(key, grants, self.timeout)
+        memo[relation] = grants
+        return grants
+
+    def has(self, user, relation, obj_id):
+        return obj_id in self.ids(user, relation)
+
+    def groups(self, user):
+        if 'groups' not in self.loaders:
+            self.register_groups()
+        return self.ids(user, 'groups')
+
+
+grants = GrantCache()
+
+
+MMAP_MAGIC = 'DRAPES01'
+_MMAP_HEADER = struct.Struct('<8sII')
+#sequence number, expiry time (0 for none), md5 of the key, length of the value
+_MMAP_SLOT = struct.Struct('<Qd16sI')
+_EMPTY_DIGEST = '\0' * 16
+
+
+class _MmapTable(object):
+    """
+    The hash table in a memory-mapped file used by MmapCache. The
+    slots are grouped into buckets of ways slots. Writers lock the
+    bucket of a key with fcntl against other processes (and with a
+    lock against other threads), and bump the sequence number of a
+    slot before and after changing it. Readers do not lock, but read
+    the sequence number before and after reading the slot, and retry
+    if it was odd or has changed.
+    """
+
+    READ_ATTEMPTS = 3
+
+    def __init__(self, path, slots, slot_size, ways):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = ways
+        self.buckets = slots // ways
+        self.capacity = slot_size - _MMAP_SLOT.size
+        self.size = _MMAP_HEADER.size + slots * slot_size
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            header = None
+            if os.fstat(self.fd).st_size >= _MMAP_HEADER.size:
+                header = _MMAP_HEADER.unpack(os.read(self.fd, _MMAP_HEADER.size))
+                if header[0] == MMAP_MAGIC and header[1:] != (slots, slot_size):
+                    raise ImproperlyConfigured(
+                        "%s is a table of %d slots of %d bytes" %
+                        ((path,) + header[1:]))
+            if os.fstat(self.fd).st_size < self.size:
+                os.ftruncate(self.fd, self.size)
+            self.map = mmap.mmap(self.fd, self.size)
+            if header is None or header[0] != MMAP_MAGIC:
+                _MMAP_HEADER.pack_into(self.map, 0, MMAP_MAGIC, slots, slot_size)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def bucket(self, digest):
+        return struct.unpack_from('<Q', digest)[0] % self.buckets
+
+    def _offset(self, bucket, way):
+        return _MMAP_HEADER.size + (bucket * self.ways + way) * self.slot_size
+
+    def locked(self, bucket):
+        return _BucketLock(self, bucket)
+
+    def read(self, digest, now):
+        """Returns the value of digest, or None if it is missing or expired."""
+        bucket = self.bucket(digest)
+        for way in range(self.ways):
+            offset = self._offset(bucket, way)
+            for _ in range(self.READ_ATTEMPTS):
+                sequence, expires, slot_digest, length = _MMAP_SLOT.unpack_from(
+                    self.map, offset)
+                if sequence & 1:
+                    continue
+                if slot_digest != digest:
+                    break
+                start = offset + _MMAP_SLOT.size
+                value = self.map[start:start + min(length, self.capacity)]
+                if struct.unpack_from('<Q', self.map, offset)[0] != sequence:
+                    continue
+                if expires and expires < now:
+                    return None
+                return value
+        return None
+
+    def find(self, digest, now):
+        """
+        With the bucket of digest locked, returns the offset of the slot
+        for digest, and whether it holds a live value for digest. If
+        the key is not there, the slot is an empty or expired one, or
+        the one that expires first.
+        """
+        bucket = self.bucket(digest)
+        replaced, replaced_expires = None, None
+        for way in range(self.ways):
+            offset = self._offset(bucket, way)
+            _, expires, slot_digest, _ = _MMAP_SLOT.unpack_from(self.map, offset)
+            live = not expires or expires >= now
+            if slot_digest == digest:
+                return offset, live
+            if slot_digest == _EMPTY_DIGEST or not live:
+                expires = -1
+            elif not expires:
+                expires = float('inf')
+            if replaced is None or expires < replaced_expires:
+                replaced, replaced_expires = offset, expires
+        return replaced, False
+
+    def value_at(self, offset):
+        _, expires, _, length = _MMAP_SLOT.unpack_from(self.map, offset)
+        start = offset + _MMAP_SLOT.size
+        return self.map[start:start + length], expires
+
+    def write(self, offset, digest, value, expires):
+        """Writes a slot; the bucket has to be locked."""
+        sequence = struct.unpack_from('<Q', self.map, offset)[0]
+        struct.pack_into('<Q', self.map, offset, sequence + 1)
+        _MMAP_SLOT.pack_into(self.map, offset, sequence + 1, expires or 0,
+                             digest, len(value))
+        start = offset + _MMAP_SLOT.size
+        self.map[start:start + len(value)] = value
+        struct.pack_into('<Q', self.map, offset, sequence + 2)
+
+
+class _BucketLock(object):
+
+    def __init__(self, table, bucket):
+        self.table = table
+        self.start = table._offset(bucket, 0)
+        self.length = table.ways * table.slot_size
+
+    def __enter__(self):
+        self.table.lock.acquire()
+        fcntl.lockf(self.table.fd, fcntl.LOCK_EX, self.length, self.start)
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.table.fd, fcntl.LOCK_UN, self.length, self.start)
+        self.table.lock.release()
+
+
+_MMAP_TABLES = {}
+_MMAP_TABLES_LOCK = threading.Lock()
+
+def _mmap_table(path, slots, slot_size, ways):
+    #one mapping per file and process; a forked child maps the file again
+    key = (path, os.getpid(), slots, slot_size, ways)
+    with _MMAP_TABLES_LOCK:
+        table = _MMAP_TABLES.get(key)
+        if table is None:
+            table = _MMAP_TABLES[key] = _MmapTable(path, slots, slot_size, ways)
+        return table
+
+
+class MmapCache(BaseCache):
+    """
+    A Django cache backend in a memory-mapped file, which is shared by
+    all processes on a host that use the same LOCATION, without an
+    external service. The file holds a hash table with a fixed number
+    of slots (OPTIONS 'SLOTS', 4096 by default) of a fixed size
+    ('SLOT_SIZE', 1024 bytes, including a header of 36 bytes). A key
+    can be stored in one of 'WAYS' (4) slots; when all of them are
+    taken, the value that expires first is replaced. Values that do
+    not fit into a slot are not stored. incr is atomic across
+    processes, which makes the backend suitable for the version
+    counters of ResponseCache and GrantCache.
+    """
+
+    def __init__(self, location, params):
+        super(MmapCache, self).__init__(params)
+        if fcntl is None:
+            raise ImproperlyConfigured("MmapCache needs the fcntl and mmap modules")
+        options = params.get('OPTIONS', {})
+        self.path = location
+        self.slots = int(options.get('SLOTS', 4096))
+        self.slot_size = int(options.get('SLOT_SIZE', 1024))
+        self.ways = int(options.get('WAYS', 4))
+        if self.slots % self.ways:
+            raise ImproperlyConfigured("SLOTS has to be a multiple of WAYS")
+
+    @property
+    def table(self):
+        return _mmap_table(self.path, self.slots, self.slot_size, self.ways)
+
+    def _digest(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return hashlib.md5(key).digest()
+
+    def get(self, key, default=None, version=None):
+        value = self.table.read(self._digest(key, version), time.time())
+        if value is None:
+            return default
+        return pickle.loads(value)
+
+    def _store(self, key, value, timeout, version, replace):
+        table = self.table
+        digest = self._digest(key, version)
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = self.get_backend_timeout(timeout)
+        with table.locked(table.bucket(digest)):
+            offset, live = table.find(digest, time.time())
+            if live and not replace:
+                return False
+            if len(value) > table.capacity:
+                #a value that does not fit must not leave an old one behind
+                if live:
+                    table.write(offset, _EMPTY_DIGEST, '', 0)
+                return False
+            table.write(offset, digest, value, expires)
+            return True
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._store(key, value, timeout, version, True)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._store(key, value, timeout, version, False)
+
+    def incr(self, key, delta=1, version=None):
+        table = self.table
+        digest = self._digest(key, version)
+        with table.locked(table.bucket(digest)):
+            offset, live = table.find(digest, time.time())
+            if not live:
+                raise ValueError("Key '%s' not found" % key)
+            value, expires = table.value_at(offset)
+            value = pickle.loads(value) + delta
+            table.write(offset, digest,
+                        pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires)
+            return value
+
+    def delete(self, key, version=None):
+        table = self.table
+        digest = self._digest(key, version)
+        with table.locked(table.bucket(digest)):
+            offset, live = table.find(digest, time.time())
+            if live:
+                table.write(offset, _EMPTY_DIGEST, '', 0)
+
+    def clear(self):
+        table = self.table
+        for bucket in range(table.buckets):
+            with table.locked(bucket):
+                for way in range(table.ways):
+                    table.write(table._offset(bucket, way), _EMPTY_DIGEST, '', 0)
+
+
+class Renderer(object):
+    """
+    Turns the dictionary returned by a controller into a response of
+    media_type. Renderers which depend on an optional library set
+    available to False if it is missing.
+    """
+
+    media_type = None
+    available = True
+    projectable = True
+
+    def render(self, request, template_name, response_dict):
+        raise NotImplementedError()
+
+
+class TemplateRenderer(Renderer):
+
+    media_type = 'text/html'
+    projectable = False
 
+    def render(self, request, template_name, response_dict):
+        return render(request, template_name, response_dict)
 
-def render_with(template_name):
+
+class JSONRenderer(Renderer):
+
+    media_type = 'application/json'
+
+    def __init__(self, content_type=None, compact=True):
+        self.content_type = content_type or self.media_type
+        if compact:
+            self.dumps = functools.partial(json.dumps, separators=(',', ':'))
+        else:
+            self.dumps = json.dumps
+
+    def render(self, request, template_name, response_dict):
+        return HttpResponse(self.dumps(response_dict), self.content_type)
+
+
+class MsgpackRenderer(Renderer):
+
+    media_type = 'application/x-msgpack'
+    available = msgpack is not None
+
+    def render(self, request, template_name, response_dict):
+        return HttpResponse(msgpack.packb(response_dict), self.media_type)
+
+
+RENDERERS = dict(html=TemplateRenderer,
+                 json=JSONRenderer,
+                 msgpack=MsgpackRenderer)
+
+def _media_matches(media_range, media_type):
+    if media_range == '*/*' or media_range == media_type:
+        return True
+    return media_range.endswith('/*') and media_type.startswith(media_range[:-1])
+
+
+class Negotiator(object):
+    """
+    Picks one of renderers according to the Accept header of a
+    request, falling back to the first one. Selections are remembered
+    per Accept header.
+    """
+
+    def __init__(self, renderers):
+        self.renderers = renderers
+        self.selected = _LRUCache()
+
+    def _select(self, accept):
+        media_ranges = []
+        for index, item in enumerate(accept.split(',')):
+            params = item.split(';')
+            quality = 1.0
+            for param in params[1:]:
+                name, _, value = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0
+            media_range = params[0].strip().lower()
+            if media_range and quality > 0:
+                media_ranges.append((-quality, index, media_range))
+        for _, _, media_range in sorted(media_ranges):
+            for renderer in self.renderers:
+                if _media_matches(media_range, renderer.media_type):
+                    return renderer
+        return self.renderers[0]
+
+    def __call__(self, request):
+        accept = request.META.get('HTTP_ACCEPT', '')
+        renderer = self.selected.get(accept)
+        if renderer is None:
+            renderer = self._select(accept)
+            self.selected.set(accept, renderer)
+        return renderer
+
+
+def _field_tree(paths):
+    tree = {}
+    for path in paths:
+        node = tree
+        parts = path.split('.')
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+def _compile_projector(tree):
+    fields = [(name, None if subtree is None else _compile_projector(subtree))
+              for name, subtree in tree.iteritems()]
+    def project(value):
+        if isinstance(value, dict):
+            projected = {}
+            for name, sub_projector in fields:
+                if name in value:
+                    projected[name] = (value[name] if sub_projector is None
+                                       else sub_projector(value[name]))
+            return projected
+        if isinstance(value, (list, tuple)):
+            return [project(item) for item in value]
+        return value
+    return project
+
+_PROJECTORS = _LRUCache(size=128)
+
+def projector(paths):
+    """
+    Returns a function that projects dictionaries (and lists of them)
+    to the given fields; nested fields are separated with dots, as in
+    'owner.name'. Projectors are cached by the fields.
+    """
+    key = tuple(sorted(set(paths)))
+    project = _PROJECTORS.get(key)
+    if project is None:
+        project = _compile_projector(_field_tree(key))
+        _PROJECTORS.set(key, project)
+    return project
+
+def _allowed_fields(requested, whitelist):
+    allowed = []
+    for path in requested:
+        for allowed_path in whitelist:
+            if path == allowed_path or path.startswith(allowed_path + '.'):
+                allowed.append(path)
+            elif allowed_path.startswith(path + '.'):
+                allowed.append(allowed_path)
+    return allowed
+
+
+def _isoformat(value):
+    return None if value is None else value.isoformat()
+
+def _text(value):
+    return None if value is None else unicode(value)
+
+_FIELD_CONVERTERS = ((models.DateTimeField, _isoformat),
+                     (models.DateField, _isoformat),
+                     (models.TimeField, _isoformat),
+                     (models.DecimalField, _text),
+                     (models.UUIDField, _text))
+
+def _serialized_field(model, name):
+    """The attribute path of a field lookup, and its JSON converter."""
+    parts = name.split('__')
+    for part in parts[:-1]:
+        model = model._meta.get_field(part).related_model
+    field = model._meta.get_field(parts[-1])
+    #foreign keys are returned as the primary key, as with values()
+    attrs = parts[:-1] + [field.attname if field.concrete else field.name]
+    for field_class, convert in _FIELD_CONVERTERS:
+        if isinstance(field, field_class):
+            return attrs, convert
+    return attrs, None
+
+def _attribute_getter(attrs):
+    def get(obj):
+        for attr in attrs:
+            if obj is None:
+                return None
+            obj = getattr(obj, attr)
+        return obj
+    return get
+
+def _compile_serializer(model, fields):
+    getters = []
+    converters = []
+    for name in fields:
+        attrs, convert = _serialized_field(model, name)
+        getters.append((name, _attribute_getter(attrs)))
+        if convert is not None:
+            converters.append((name, convert))
+
+    def serialize(obj):
+        item = dict((name, get(obj)) for name, get in getters)
+        for name, convert in converters:
+            item[name] = convert(item[name])
+        return item
+
+    def serialize_row(row):
+        item = dict((name, row[name]) for name in fields)
+        for name, convert in converters:
+            item[name] = convert(item[name])
+        return item
+    return serialize, serialize_row
+
+
+SERIALIZER_REGISTER = {}
+
+class ModelSerializerMeta(type):
+
+    def __init__(cls, name, bases, dct):
+        super(ModelSerializerMeta, cls).__init__(name, bases, dct)
+        if 'model' in dct and dct['model']:
+            SERIALIZER_REGISTER[dct['model']] = cls
+
+
+class ModelSerializer(object):
+    """
+    Declares the fields of model that are returned for its instances
+    and querysets by render_with, with all formats except templates.
+    fields are field names or lookups of related fields, such as
+    'owner__name'; foreign keys are returned as primary keys. The
+    functions that turn an instance or a row of values() into a
+    dictionary are built the first time they are used.
+    """
+
+    __metaclass__ = ModelSerializerMeta
+    model = None
+    fields = ()
+    _compiled = {}
+
+    @classmethod
+    def _functions(cls):
+        functions = cls._compiled.get(cls)
+        if functions is None:
+            functions = _compile_serializer(cls.model, tuple(cls.fields))
+            cls._compiled[cls] = functions
+        return functions
+
+    @classmethod
+    def serialize(cls, obj):
+        return cls._functions()[0](obj)
+
+    @classmethod
+    def serialize_row(cls, row):
+        return cls._functions()[1](row)
+
+    @classmethod
+    def serialize_queryset(cls, queryset):
+        """Serializes a queryset through values(), without creating instances."""
+        return map(cls.serialize_row, queryset.values(*cls.fields))
+
+
+def _is_model_queryset(value):
+    return (isinstance(value, QuerySet) and
+            issubclass(value._iterable_class, ModelIterable))
+
+def serialize(value):
+    """
+    Serializes value with the ModelSerializer of its model, if it is an
+    instance, a queryset, or a list or tuple of instances of a model
+    that has one, and returns it unchanged otherwise.
+    """
+    if isinstance(value, models.Model):
+        serializer = SERIALIZER_REGISTER.get(value.__class__)
+        if serializer is not None:
+            return serializer.serialize(value)
+    elif isinstance(value, (list, tuple)):
+        #lists of other things are not walked
+        if value and isinstance(value[0], models.Model):
+            return [serialize(item) for item in value]
+    elif _is_model_queryset(value):
+        serializer = SERIALIZER_REGISTER.get(value.model)
+        if serializer is not None:
+            return serializer.serialize_queryset(value)
+    return value
+
+def _serialize_models(response_dict):
+    if not SERIALIZER_REGISTER or not isinstance(response_dict, dict):
+        return response_dict
+    return dict((key, serialize(value))
+                for key, value in response_dict.iteritems())
+
+
+class ListResult(object):
+    """
+    A page of a queryset, to be returned by controllers decorated with
+    render_with. The page starts after cursor (see Cursor) in the order
+    given by order_by, or else at page (counted from 1), and holds at
+    most limit items.
+    Items are fetched chunk_size at a time, and passed through
+    serialize if given; with JSON, the response is streamed, so only
+    one chunk of items is in memory at a time. The cursor for the next
+    page is next_cursor, which is set once the items are consumed, and
+    None on the last page.
+    """
+
+    def __init__(self, queryset, order_by='pk', cursor=None, limit=20,
+                 page=None, chunk_size=100, serialize=None, key='items'):
+        self.descending = order_by.startswith('-')
+        self.order_field = order_by.lstrip('-')
+        #rows of values() querysets have the primary key under its name
+        self.value_field = (queryset.model._meta.pk.attname
+                            if self.order_field == 'pk' else self.order_field)
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self.serialize = serialize
+        self.key = key
+        self.next_cursor = None
+        if page is not None and page < 1:
+            raise ValueError("Pages are counted from 1, not %r" % (page,))
+        queryset = queryset.order_by(order_by)
+        if cursor is not None:
+            lookup = '%s__%s' % (self.order_field, 'lt' if self.descending else 'gt')
+            queryset = queryset.filter(**{lookup: cursor})
+        elif page is not None:
+            queryset = queryset[(page - 1) * limit:]
+        #one more than needed, to find out whether there is a next page
+        self.queryset = queryset[:limit + 1]
+
+    def use_serializer(self, serializer):
+        """
+        Fetches the items through values() and passes them through
+        serializer (a ModelSerializer), unless they are already values
+        or serialize is given.
+        """
+        if self.serialize is None and _is_model_queryset(self.queryset):
+            fields = tuple(serializer.fields)
+            if self.value_field not in fields:
+                fields += (self.value_field,)
+            self.queryset = self.queryset.values(*fields)
+            self.serialize = serializer.serialize_row
+
+    def _order_value(self, item):
+        if isinstance(item, dict):
+            return item[self.value_field]
+        return getattr(item, self.order_field)
+
+    def _iterator(self):
+        if django.VERSION >= (2, 0):
+            return self.queryset.iterator(chunk_size=self.chunk_size)
+        return self.queryset.iterator()
+
+    def __iter__(self):
+        self.next_cursor = None
+        last = None
+        for count, item in enumerate(self._iterator()):
+            if count == self.limit:
+                self.next_cursor = encode_cursor(self._order_value(last))
+                break
+            last = item
+            yield self.serialize(item) if self.serialize else item
+
+    def as_dict(self):
+        items = list(self)
+        return {self.key: items, 'next': self.next_cursor}
+
+    def json_chunks(self, dumps, project=None):
+        yield '{"%s":[' % self.key
+        chunk = []
+        separator = ''
+        for item in self:
+            if project is not None:
+                item = project(item)
+            chunk.append(dumps(item))
+            if len(chunk) == self.chunk_size:
+                yield separator + ','.join(chunk)
+                separator = ','
+                chunk = []
+        if chunk:
+            yield separator + ','.join(chunk)
+        yield '],"next":%s}' % dumps(self.next_cursor)
+
+
+def _item_fields(requested, key):
+    prefix = key + '.'
+    if key in requested:
+        return None
+    return [path[len(prefix):] for path in requested if path.startswith(prefix)]
+
+
+def _renderer(renderer):
+    if isinstance(renderer, basestring):
+        return RENDERERS[renderer]()
+    return renderer
+
+
+def render_with(template_name, etag=None, last_modified=None, cache=None,
+                formats=None, fields=None):
     """
     A decorator that turns the output of a controller into a rendered
     template.
+
+    etag and last_modified are strategies for answering conditional
+    requests: functions that accept a dictionary of the arguments to the
+    controller (i.e. already converted by verify) and return a version
+    string or a datetime. If the request matches them, 304 Not
+    Modified is returned without calling the controller. See
+    version_of and latest_of. etag can also be 'content', in which case
+    the ETag is a hash of the response body; this saves only the
+    bandwidth.
+
+    With cache (a ResponseCache, or a timeout in seconds), responses
+    are cached, and served from the cache without calling the
+    controller. Since the permissions checked by require are part of
+    the cache key, require has to be applied before render_with.
+
+    formats is an optional list of renderers (see Renderer), or the
+    names of builtin ones ('html', 'json', 'msgpack'); renderers whose
+    library is not installed are left out. If given, the renderer is
+    chosen according to the Accept header of the request, the first one
+    being the default. A 'json' template name or request parameter
+    always leads to JSON.
+
+    fields enables projecting the returned dictionary to a subset of
+    its fields for all renderers except templates. If it is a list of
+    field names (see projector), only these are returned; the fields
+    request parameter, a comma-separated list, can be used to ask for
+    a subset of them. If fields is True, any fields can be asked for.
+
+    Controllers can also return a ListResult, which is streamed with
+    JSON, and rendered as a dictionary of the items and the next
+    cursor otherwise. Such responses are not cached.
+
+    Except with templates, model instances, lists of them and
+    querysets in the returned dictionary, as well as the items of a
+    ListResult, are serialized with the ModelSerializer of their model, if there is one.
     """
-    @decorator
-    def replacement_func(view_func, *args, **kwargs):
-        response_dict = view_func(*args, **kwargs)
-        if isinstance(response_dict, HttpResponse):
-            return response_dict
-        real_template_name = template_name
-        if hasattr(response_dict, 'has_key') and response_dict.has_key('template'):
-            real_template_name = response_dict['template']
-        if real_template_name == 'json' or is_json(args[0]):
-            return HttpResponse(json.dumps(response_dict),
-                                'application/javascript')
-        return render(args[0],
-                      real_template_name,
-                      response_dict)
-    return replacement_func
+    hash_content = etag == 'content'
+    if hash_content:
+        etag = None
+    if cache is not None and not isinstance(cache, ResponseCache):
+        cache = ResponseCache(timeout=cache)
+    template_renderer = TemplateRenderer()
+    if formats is None:
+        negotiator = None
+        json_renderer = JSONRenderer(content_type='application/javascript',
+                                     compact=False)
+    else:
+        renderers = [renderer for renderer in map(_renderer, formats)
+                     if renderer.available]
+        negotiator = Negotiator(renderers)
+        json_renderer = ([renderer for renderer in renderers
+                          if isinstance(renderer, JSONRenderer)] or
+                         [JSONRenderer()])[0]
+
+    whitelist = None if fields in (None, True) else tuple(fields)
+
+    def _requested_fields(request):
+        if fields is None:
+            return None
+        requested = request.GET.get('fields')
+        if not requested:
+            return whitelist
+        requested = [path.strip() for path in requested.split(',') if path.strip()]
+        if whitelist is None:
+            return requested
+        return _allowed_fields(requested, whitelist)
+
+    def _render_list(request, real_template_name, renderer, result):
+        project = None
+        requested = (_requested_fields(request)
+                     if fields is not None and renderer.projectable else None)
+        if requested is not None:
+            item_fields = _item_fields(requested, result.key)
+            if item_fields is not None:
+                project = projector(item_fields)
+        serializer = (SERIALIZER_REGISTER.get(result.queryset.model)
+                      if renderer.projectable else None)
+        if serializer is not None:
+            result.use_serializer(serializer)
+        if isinstance(renderer, JSONRenderer):
+            response = StreamingHttpResponse(result.json_chunks(renderer.dumps,
+                                                                project),
+                                             content_type=renderer.content_type)
+        else:
+            response_dict = result.as_dict()
+            if project is not None:
+                response_dict[result.key] = map(project, response_dict[result.key])
+            response = renderer.render(request, real_template_name, response_dict)
+        return response
+
+    def _select_renderer(request, real_template_name):
+        if real_template_name == 'json' or is_json(request):
+            return json_renderer
+        if negotiator is None:
+            return template_renderer
+        return negotiator(request)
+
+    def _validators(args_dict):
+        etag_value = _quoted_etag(str(etag(args_dict))) if etag else None
+        timestamp = None
+        if last_modified:
+            modified = last_modified(args_dict)
+            timestamp = calendar.timegm(modified.utctimetuple())
+        return etag_value, timestamp
+
+    def wrap(view_func):
+        argspec = _argspec(view_func)
+        view_name = '%s.%s' % (view_func.__module__, view_func.__name__)
+
+        def replacement_func(view_func, *args, **kwargs):
+            request = args[0]
+            etag_value = timestamp = cache_key = None
+            if etag or last_modified or cache is not None:
+                args_dict = dict(zip(argspec.args, args))
+                args_dict.update(kwargs)
+            if etag or last_modified:
+                etag_value, timestamp = _validators(args_dict)
+                if _is_not_modified(request, etag_value, timestamp):
+                    return _set_validators(HttpResponseNotModified(),
+                                           etag_value, timestamp)
+            if cache is not None and cache.applies_to(request):
+                variant = '%s:%s' % (_select_renderer(request, template_name).media_type,
+                                     _requested_fields(request))
+                cache_key = cache.key(view_name, template_name, request,
+                                      args_dict, variant)
+                response = cache.cache.get(cache_key)
+                if response is not None:
+                    return response
+            response_dict = view_func(*args, **kwargs)
+            if isinstance(response_dict, HttpResponse):
+                return response_dict
+            real_template_name = template_name
+            if hasattr(response_dict, 'has_key') and response_dict.has_key('template'):
+                real_template_name = response_dict['template']
+            renderer = _select_renderer(request, real_template_name)
+            if isinstance(response_dict, ListResult):
+                response = _render_list(request, real_template_name, renderer,
+                                        response_dict)
+            else:
+                if renderer.projectable:
+                    response_dict = _serialize_models(response_dict)
+                if fields is not None and renderer.projectable:
+                    requested = _requested_fields(request)
+                    if requested is not None:
+                        response_dict = projector(requested)(response_dict)
+                response = renderer.render(request, real_template_name, response_dict)
+            if negotiator is not None:
+                patch_vary_headers(response, ('Accept',))
+            streaming = getattr(response, 'streaming', False)
+            if hash_content and not streaming:
+                etag_value = _quoted_etag(response.content)
+                if _is_not_modified(request, etag_value, None):
+                    return _set_validators(HttpResponseNotModified(),
+                                           etag_value, timestamp)
+            if etag_value is not None or timestamp is not None:
+                _set_validators(response, etag_value, timestamp)
+            if (cache_key is not None and response.status_code == 200 and
+                not streaming and cache.storable(request, response)):
+                cache.cache.set(cache_key, response, cache.timeout)
+            return response
+        return _decorate(replacement_func, view_func, argspec)
+    return wrap
 
 
 def json_or_redirect(redirect):
@@ -309,8 +2600,9 @@ def json_or_redirect(redirect):
 class ModelAttributeMixin(object):
 
     def __getattr__(self, attr_name):
-        if hasattr(self.obj, attr_name):
-            return getattr(self.obj, attr_name)
+        obj = resolve(self.obj)
+        if hasattr(obj, attr_name):
+            return getattr(obj, attr_name)
         raise AttributeError("Neither %s nor %s view have attribute %s" %
                              (self.obj.__class__,
                               self.__class__,
@@ -330,6 +2622,9 @@ class ModelView(ModelAttributeMixin):
     __metaclass__ = ModelViewMeta
     model = None
     VIEW_REGISTER = {}
+    #related objects used by the view methods; see prefetch_dependencies
+    select_related = ()
+    prefetch_related = ()
 
     def __init__(self, obj):
         self.obj = obj
@@ -354,6 +2649,8 @@ class ModelPermission(ModelAttributeMixin):
 
     __metaclass__ = ModelPermissionMeta
     model = None
+    select_related = ()
+    prefetch_related = ()
 
     def __init__(self, obj):
         self.obj = obj
@@ -364,6 +2661,235 @@ class ModelPermission(ModelAttributeMixin):
         perm = perm_class(model)
         return perm
 
+    def has_grant(self, user, relation):
+        """Whether the object is among the grants of user for relation."""
+        return grants.has(user, relation, self.obj.pk)
+
+    @classmethod
+    def acl_entries(cls, permission, objects):
+        """
+        Bulk hook for AclTable. Yields an (object id, user id, group id)
+        tuple, with either the user or the group id None, for every
+        user and group that has permission on one of objects.
+        """
+        raise NotImplementedError("%s does not implement acl_entries" %
+                                  cls.__name__)
+
+
+ACL_REGISTER = {}
+
+def make_acl_model(app_label, name='DrapesAcl'):
+    """
+    Creates the model of a materialized ACL table for AclTable. Since
+    drapes is not an app, the model has to be created in the models
+    module of one of your apps, whose label is app_label.
+    """
+    meta = type('Meta', (), dict(
+            app_label=app_label,
+            index_together=[('content_type', 'permission', 'user_id'),
+                            ('content_type', 'permission', 'group_id'),
+                            ('content_type', 'object_id')]))
+    return type(name, (models.Model,), dict(
+            __module__=app_label + '.models',
+            Meta=meta,
+            content_type=models.CharField(max_length=100),
+            object_id=models.BigIntegerField(),
+            permission=models.CharField(max_length=100),
+            user_id=models.IntegerField(null=True),
+            group_id=models.IntegerField(null=True)))
+
+
+class AclTable(object):
+    """
+    Keeps the outcome of ModelPermission methods for the models it is
+    enabled for in a denormalized ACL model (see make_acl_model), so
+    that require and if_allowed check these permissions with an
+    indexed lookup, and querysets can be filtered with a join. The
+    entries are computed by the acl_entries hook of the model
+    permission, for all instances with rebuild, in chunks of
+    chunk_size, and for single instances when they are saved or their
+    many-to-many relations through the through models change.
+    """
+
+    def __init__(self, acl_model, chunk_size=1000):
+        self.acl_model = acl_model
+        self.chunk_size = chunk_size
+        self.permissions = {}
+        self.through = {}
+
+    def enable(self, model, permissions, through=()):
+        self.permissions[model] = tuple(permissions)
+        self.through[model] = tuple(through)
+        ACL_REGISTER[model] = self
+        post_save.connect(self._saved, sender=model)
+        post_delete.connect(self._deleted, sender=model)
+        for sender in through:
+            m2m_changed.connect(self._m2m_changed, sender=sender)
+
+    def disable(self, model):
+        post_save.disconnect(self._saved, sender=model)
+        post_delete.disconnect(self._deleted, sender=model)
+        for sender in self.through.pop(model):
+            m2m_changed.disconnect(self._m2m_changed, sender=sender)
+        del self.permissions[model]
+        del ACL_REGISTER[model]
+
+    def covers(self, model, permission):
+        return permission in self.permissions.get(model, ())
+
+    def _rows(self, model):
+        return self.acl_model.objects.filter(content_type=model._meta.label_lower)
+
+    def _entries(self, model, objects):
+        perm_class = PERMISSION_REGISTER[model]
+        for permission in self.permissions[model]:
+            for object_id, user_id, group_id in perm_class.acl_entries(permission,
+                                                                       objects):
+                yield self.acl_model(content_type=model._meta.label_lower,
+                                     object_id=object_id,
+                                     permission=permission,
+                                     user_id=user_id,
+                                     group_id=group_id)
+
+    def rebuild(self, model):
+        """Recomputes all entries for model, and returns their number."""
+        queryset = prefetch_dependencies(model._default_manager.order_by('pk'))
+        count = 0
+        with transaction.atomic(using=self.acl_model.objects.db):
+            self._rows(model).delete()
+            last_pk = None
+            while True:
+                chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                objects = list(chunk[:self.chunk_size])
+                if not objects:
+                    break
+                entries = list(self._entries(model, objects))
+                self.acl_model.objects.bulk_create(entries,
+                                                   batch_size=self.chunk_size)
+                count += len(entries)
+                last_pk = objects[-1].pk
+        return count
+
+    def refresh(self, model, objects):
+        objects = list(objects)
+        with transaction.atomic(using=self.acl_model.objects.db):
+            self._rows(model).filter(object_id__in=[obj.pk for obj in objects]).delete()
+            self.acl_model.objects.bulk_create(list(self._entries(model, objects)))
+
+    def _saved(self, sender, instance, **kwargs):
+        self.refresh(sender, [instance])
+
+    def _deleted(self, sender, instance, **kwargs):
+        self._rows(sender).filter(object_id=instance.pk).delete()
+
+    def _related_ids(self, through, model, instance):
+        """The ids of the instances of model related to instance in through."""
+        source = target = None
+        for field in through._meta.fields:
+            related_model = getattr(field, 'related_model', None)
+            if related_model is model:
+                target = field
+            elif related_model is not None and isinstance(instance, related_model):
+                source = field
+        if source is None or target is None:
+            return []
+        return list(through._default_manager.filter(**{source.attname: instance.pk})
+                    .values_list(target.attname, flat=True))
+
+    def _m2m_changed(self, sender, instance, action, model, pk_set, **kwargs):
+        for enabled, through in self.through.items():
+            if sender not in through:
+                continue
+            if isinstance(instance, enabled):
+                if action.startswith('post_'):
+                    self.refresh(enabled, [instance])
+            elif action == 'pre_clear':
+                #the relations are gone after the clear, so that the
+                #objects to refresh have to be found before
+                cleared = instance.__dict__.setdefault('_drapes_acl_cleared', {})
+                cleared[(id(self), enabled)] = self._related_ids(sender, enabled,
+                                                                 instance)
+            elif action == 'post_clear':
+                cleared = instance.__dict__.get('_drapes_acl_cleared', {})
+                object_ids = cleared.pop((id(self), enabled), [])
+                self.refresh(enabled, enabled._default_manager.filter(pk__in=object_ids))
+            elif action.startswith('post_') and model is enabled:
+                self.refresh(enabled, enabled._default_manager.filter(pk__in=pk_set))
+
+    def _subjects(self, user):
+        subjects = Q(user_id=user.pk)
+        groups = getattr(user, 'groups', None)
+        if groups is not None:
+            subjects |= Q(group_id__in=groups.values('pk'))
+        return subjects
+
+    def allows(self, user, obj, permission):
+        if getattr(user, 'pk', None) is None:
+            return False
+        return self._rows(obj.__class__).filter(self._subjects(user),
+                                                object_id=obj.pk,
+                                                permission=permission).exists()
+
+    def filter(self, queryset, user, permission):
+        """The objects of queryset on which user has permission."""
+        if getattr(user, 'pk', None) is None:
+            return queryset.none()
+        object_ids = self._rows(queryset.model).filter(
+            self._subjects(user), permission=permission).values('object_id')
+        return queryset.filter(pk__in=object_ids)
+
+
+def acl_filter(queryset, user, permission):
+    return ACL_REGISTER[queryset.model].filter(queryset, user, permission)
+
+
+class AclRebuildCommand(BaseCommand):
+    """
+    Management command rebuilding materialized ACL entries. Since
+    drapes is not an app, it has to be exposed as a command of one of
+    your apps, e.g. in management/commands/rebuild_acl.py:
+
+        from django_drapes import AclRebuildCommand as Command
+    """
+
+    help = ('Rebuilds the ACL entries of the given models '
+            '(app_label.ModelName), or of all models with an ACL table.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*')
+
+    def handle(self, *args, **options):
+        from django.apps import apps
+        models = [apps.get_model(label) for label in options['models']]
+        for model in models or sorted(ACL_REGISTER, key=lambda model: model._meta.label):
+            if model not in ACL_REGISTER:
+                raise CommandError('%s has no ACL table' % model._meta.label)
+            count = ACL_REGISTER[model].rebuild(model)
+            self.stdout.write('%s: %d entries' % (model._meta.label, count))
+
+
+def prefetch_dependencies(queryset):
+    """
+    Applies the select_related and prefetch_related paths declared by
+    the ModelView and ModelPermission of the model of queryset, so that
+    rendering views and checking permissions for all of its instances
+    does not need any further queries.
+    """
+    select_related, prefetch_related = [], []
+    for cls in [ModelView.VIEW_REGISTER.get(queryset.model),
+                PERMISSION_REGISTER.get(queryset.model)]:
+        if cls is None:
+            continue
+        select_related.extend(path for path in cls.select_related
+                              if path not in select_related)
+        prefetch_related.extend(path for path in cls.prefetch_related
+                                if path not in prefetch_related)
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    return queryset
+
 
 class NoSuchView(Exception):
     pass
@@ -378,22 +2904,12 @@ class ModelViewNode(Node):
 
     def render(self, context):
         model = self.model.resolve(context)
-        view = ModelView.get_for_model(model)
         def parse_variable(arg):
             return arg if not hasattr(arg, 'resolve') else arg.resolve(context)
-        b = [(key, parse_variable(value)) for key, value in self.kwargs.iteritems()]
-        try:
-            view_thing = getattr(view,
-                                 self.viewname)
-        except AttributeError:
-            raise NoSuchView(self.viewname)
-        if callable(view_thing):
-            return view_thing(*map(lambda x: parse_variable(x), self.args),
-                               **dict([(key, parse_variable(value))
-                                       for key, value in self.kwargs.iteritems()]))
-        else:
-            assert not (self.args or self.kwargs)
-        return view_thing
+        return render_view(model, self.viewname,
+                           *map(parse_variable, self.args),
+                           **dict([(key, parse_variable(value))
+                                   for key, value in self.kwargs.iteritems()]))
 
     def parse_arg(self, arg):
         if any(arg.startswith(x) and arg.startswith(x)
@@ -424,6 +2940,27 @@ def modelview(parser, token):
     return ModelViewNode(model, view_name, args=args, kwargs=kwargs)
 
 
+def render_view(model_instance, viewname, *args, **kwargs):
+    """What the modelview tag renders for model_instance and viewname."""
+    view = ModelView.get_for_model(model_instance)
+    try:
+        view_thing = getattr(view, viewname)
+    except AttributeError:
+        raise NoSuchView(viewname)
+    if callable(view_thing):
+        return view_thing(*args, **kwargs)
+    else:
+        assert not (args or kwargs)
+    return view_thing
+
+def allowed(user, model_instance, permission_name):
+    """Whether the if_allowed tag renders its first part."""
+    acl = ACL_REGISTER.get(model_instance.__class__)
+    if acl is not None and acl.covers(model_instance.__class__, permission_name):
+        return acl.allows(user, model_instance, permission_name)
+    permissions = PERMISSION_REGISTER[model_instance.__class__](model_instance)
+    return getattr(permissions, permission_name)(user)
+
 def v(model_instance):
     return ModelView.get_for_model(model_instance)
 
@@ -455,8 +2992,7 @@ class ModelPermissionNode(Node):
     def render(self, context):
         user = self.user.resolve(context)
         model_instance = self.model_instance.resolve(context)
-        permissions = PERMISSION_REGISTER[model_instance.__class__](model_instance)
-        if getattr(permissions, self.permission_name)(user):
+        if allowed(user, model_instance, self.permission_name):
             return self.nodelist_true.render(context)
         return self.nodelist_false.render(context)
 
@@ -479,6 +3015,81 @@ def model_permission(parser, token):
                                nodelist_true, nodelist_false)
 
 
+class DrapesExtension(Extension):
+    """
+    Jinja2 extension with the if_allowed and modelview tags, which work
+    like the Django template tags and are compiled into calls to
+    allowed and render_view:
+
+        {% if_allowed user can_edit thing %} ... {% else %} ... {% end_if_allowed %}
+        {% modelview thing link 'edit' size=small_size %}
+
+    The view and permission names can also be given as strings. The
+    extension also adds v, p and allowed as globals.
+    """
+
+    tags = set(['if_allowed', 'modelview'])
+
+    def __init__(self, environment):
+        super(DrapesExtension, self).__init__(environment)
+        environment.globals.update(v=v, p=p, allowed=allowed)
+
+    def parse(self, parser):
+        if parser.stream.current.value == 'if_allowed':
+            return self._parse_if_allowed(parser)
+        return self._parse_modelview(parser)
+
+    def _parse_name(self, parser):
+        token = parser.stream.current
+        if token.type in ('name', 'string'):
+            next(parser.stream)
+            return nodes.Const(token.value, lineno=token.lineno)
+        parser.fail('expected a name', token.lineno)
+
+    def _parse_if_allowed(self, parser):
+        lineno = next(parser.stream).lineno
+        user = parser.parse_expression()
+        permission_name = self._parse_name(parser)
+        model_instance = parser.parse_expression()
+        body = parser.parse_statements(('name:else', 'name:end_if_allowed'))
+        if next(parser.stream).value == 'else':
+            else_ = parser.parse_statements(('name:end_if_allowed',),
+                                            drop_needle=True)
+        else:
+            else_ = []
+        node = nodes.If(lineno=lineno)
+        node.test = self.call_method('_allowed',
+                                     [user, model_instance, permission_name],
+                                     lineno=lineno)
+        node.body, node.elif_, node.else_ = body, [], else_
+        return node
+
+    def _parse_modelview(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression(), self._parse_name(parser)]
+        kwargs = []
+        while parser.stream.current.type != 'block_end':
+            if (parser.stream.current.type == 'name' and
+                parser.stream.look().type == 'assign'):
+                key = next(parser.stream).value
+                next(parser.stream)
+                kwargs.append(nodes.Keyword(key, parser.parse_expression(),
+                                            lineno=lineno))
+            else:
+                args.append(parser.parse_expression())
+        return nodes.Output([self.call_method('_modelview', args, kwargs,
+                                              lineno=lineno)],
+                            lineno=lineno)
+
+    def _allowed(self, user, model_instance, permission_name):
+        return allowed(user, model_instance, permission_name)
+
+    def _modelview(self, model_instance, viewname, *args, **kwargs):
+        #tag output is not escaped by the Django template engine either
+        return jinja2.Markup(render_view(model_instance, viewname,
+                                         *args, **kwargs))
+
+
 # TODO:
 # -test json as argument from verify or require
 # -add tests for add_context